@@ -0,0 +1,387 @@
+"""
+/callback 離線壓力測試。
+
+以 LINE_CHANNEL_SECRET 產生正確簽章的 webhook 內容，直接打進 Flask app，
+Google Sheet 與 LINE Messaging API 都換成程序內的假物件 (可設定延遲與配額錯誤)，
+最後輸出吞吐量、p50/p95/p99 延遲與每個指令平均呼叫幾次 Sheets。
+
+用法：
+    python benchmark.py --players 200 --concurrency 20 --leaderboard-storm 500 \
+        --sheets-latency 300 --line-latency 80 --quota-error-rate 0.05
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="tsse-linebot /callback 壓力測試")
+    parser.add_argument('--players', type=int, default=100, help="完整玩一輪遊戲的玩家數")
+    parser.add_argument('--concurrency', type=int, default=10, help="同時送出 webhook 的玩家數")
+    parser.add_argument('--leaderboard-storm', type=int, default=200, help="同時按「排行榜」的次數")
+    parser.add_argument('--existing-rows', type=int, default=2000, help="工作表中預先放入的歷史紀錄筆數")
+    parser.add_argument('--sheets-latency', type=float, default=300, help="每次 Sheets 呼叫的延遲 (毫秒)")
+    parser.add_argument('--line-latency', type=float, default=80, help="每次 LINE 回覆的延遲 (毫秒)")
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help="Sheets 呼叫回傳 429 配額錯誤的機率")
+    parser.add_argument('--workers', type=int, default=None, help="覆寫 WEBHOOK_WORKERS")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="保留 main.py 在處理過程中的 print 輸出")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+random.seed(ARGS.seed)
+
+CHANNEL_SECRET = 'benchmark-secret'
+_tmpdir = tempfile.mkdtemp(prefix='linebot-bench-')
+os.environ.update({
+    'LINE_CHANNEL_ACCESS_TOKEN': 'benchmark-token',
+    'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+    'GOOGLE_SHEET_NAME': 'benchmark',
+    'STORAGE_DB_PATH': os.path.join(_tmpdir, 'linebot.sqlite3'),
+    'SESSION_DB_PATH': os.path.join(_tmpdir, 'sessions.sqlite3'),
+    'PHOTO_ARCHIVE_DIR': os.path.join(_tmpdir, 'photos'),
+})
+if ARGS.workers is not None:
+    os.environ['WEBHOOK_WORKERS'] = str(ARGS.workers)
+
+import gspread
+import requests
+
+import main
+
+# ====== 目前執行中的指令 (用來把 Sheets 呼叫歸到對應的指令) ======
+_current = threading.local()
+BACKGROUND = '(背景同步)'
+
+
+def current_command():
+    return getattr(_current, 'command', BACKGROUND)
+
+
+# ====== 假的 Google Sheet ======
+class FakeWorksheet:
+    """行為與 gspread.Worksheet 相同的最小子集，並加上可設定的延遲與 429 配額錯誤。"""
+    HEADER = ["編號", "名稱", "完成時間", "花費秒數", "LINE User ID", "是否已兌獎", "首次通關", "玩家編號", "遊玩次數"]
+
+    def __init__(self, rows, latency, quota_error_rate, spreadsheet=None, header=True):
+        self.rows = ([self.HEADER] if header else []) + rows
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self._lock = threading.Lock()
+        self.calls = collections.defaultdict(collections.Counter) # 指令 -> {方法: 次數}
+        self.quota_errors = 0
+        self.spreadsheet = spreadsheet or FakeSpreadsheet(self)
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[current_command()][method] += 1
+        time.sleep(self.latency)
+        if self.quota_error_rate and random.random() < self.quota_error_rate:
+            with self._lock:
+                self.quota_errors += 1
+            response = requests.Response()
+            response.status_code = 429
+            response._content = json.dumps({'error': {'code': 429, 'message': 'Quota exceeded (benchmark)', 'status': 'RESOURCE_EXHAUSTED'}}).encode()
+            raise gspread.exceptions.APIError(response)
+
+    def get_all_values(self):
+        self._call('get_all_values')
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def append_rows(self, values, **kwargs):
+        self._call('append_rows')
+        with self._lock:
+            start = len(self.rows) + 1
+            self.rows.extend([[str(v) for v in row] for row in values])
+            return {'updates': {'updatedRange': f"Sheet1!A{start}:I{len(self.rows)}"}}
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        with self._lock:
+            for item in data:
+                row = int(item['range'][1:])
+                self.rows[row - 1][5] = item['values'][0][0]
+
+    def get_values(self, range_name):
+        # 只支援整列範圍，例如 "1:120" (熱表輪替)
+        self._call('get_values')
+        first, last = (int(part) for part in range_name.split(':'))
+        with self._lock:
+            return [list(row) for row in self.rows[first - 1:last]]
+
+    def row_values(self, row):
+        self._call('row_values')
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def update(self, values, range_name=None, **kwargs):
+        # 只支援從 A1 開始整塊覆寫 (封存表與摘要)
+        self._call('update')
+        with self._lock:
+            for index, row in enumerate(values):
+                if index < len(self.rows):
+                    self.rows[index] = [str(v) for v in row]
+                else:
+                    self.rows.append([str(v) for v in row])
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('delete_rows')
+        with self._lock:
+            del self.rows[start_index - 1:end_index or start_index]
+
+    def __getattr__(self, name):
+        # 其他 gspread 方法 (find、cell、insert_row…) 只計數，不模擬內容
+        def method(*args, **kwargs):
+            self._call(name)
+        return method
+
+
+def make_existing_rows(count):
+    rows = []
+    for i in range(1, count + 1):
+        player_id = (i + 1) // 2
+        play_count = 2 - i % 2
+        rows.append([f"{player_id}-{play_count}", f"歷史玩家{player_id}", "2025-07-01 10:00:00",
+                     str(round(random.uniform(60, 900), 2)), f"Uhistory{player_id:08d}",
+                     random.choice(["是", "否"]), "是" if play_count == 1 else "否", str(player_id), str(play_count)])
+    return rows
+
+
+class FakeSpreadsheet:
+    """熱表輪替用到的 Spreadsheet 方法：依標題取得或新增工作表。"""
+    def __init__(self, sheet1):
+        self.sheet1 = sheet1
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        self.sheet1._call('worksheet')
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.sheet1._call('add_worksheet')
+        self.worksheets[title] = FakeWorksheet([], self.sheet1.latency, self.sheet1.quota_error_rate, self, header=False)
+        return self.worksheets[title]
+
+
+# ====== 假的 LINE Messaging API ======
+class FakeLineApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.replies = 0
+        self._lock = threading.Lock()
+
+    def reply(self, reply_token, *messages):
+        for message in messages:
+            json.loads(message) # 確認預先序列化的訊息是合法 JSON
+        time.sleep(self.latency)
+        with self._lock:
+            self.replies += 1
+
+    def open_content(self, message_id):
+        time.sleep(self.latency)
+        return FakeContent(os.urandom(200 * 1024))
+
+
+class FakeContent:
+    """模擬 requests 的串流回應 (打卡照片下載)。"""
+    headers = {'Content-Type': 'image/jpeg'}
+
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+# ====== 產生簽章過的 webhook ======
+_event_ids = itertools.count(1)
+
+
+def _event(user_id, message):
+    event_id = next(_event_ids)
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "webhookEventId": f"01BENCH{event_id:019d}", "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply-{event_id}", "source": {"type": "user", "userId": user_id},
+        "message": dict(message, id=str(event_id)),
+    }
+
+
+def text_event(user_id, text):
+    return _event(user_id, {"type": "text", "text": text, "quoteToken": "q"})
+
+
+def image_event(user_id):
+    return _event(user_id, {"type": "image", "contentProvider": {"type": "line"}, "quoteToken": "q"})
+
+
+def signed_body(*events):
+    body = json.dumps({"destination": "Ubenchmark", "events": list(events)}, ensure_ascii=False).encode('utf-8')
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def command_label(event):
+    """把事件歸類成指令名稱 (文字指令或 progress 階段)。"""
+    if isinstance(event.message, main.ImageMessage):
+        return '(圖片)'
+    text = event.message.text.strip()
+    if text in ("開始遊戲", "排行榜", "兌換獎項", "PASS", "我已拍照打卡完畢", "A", "B", "C"):
+        return text
+    return '(輸入名稱)'
+
+
+# ====== 量測 ======
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handler_latency = collections.defaultdict(list)
+        self.http_latency = []
+        self.http_errors = collections.Counter()
+        self.failed = 0
+
+    def add_handler(self, command, seconds):
+        with self._lock:
+            self.handler_latency[command].append(seconds)
+
+    def add_http(self, seconds, status):
+        with self._lock:
+            self.http_latency.append(seconds)
+            if status != 200:
+                self.http_errors[status] += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+recorder = Recorder()
+_original_dispatch = main.dispatch_event
+
+
+def timed_dispatch(event):
+    command = command_label(event)
+    _current.command = command
+    started = time.perf_counter()
+    try:
+        _original_dispatch(event)
+    except Exception:
+        recorder.failed += 1
+        raise
+    finally:
+        recorder.add_handler(command, time.perf_counter() - started)
+        _current.command = BACKGROUND
+
+
+def post(client, *events):
+    body, signature = signed_body(*events)
+    started = time.perf_counter()
+    response = client.post('/callback', data=body, headers={'X-Line-Signature': signature, 'Content-Type': 'application/json'})
+    recorder.add_http(time.perf_counter() - started, response.status_code)
+
+
+def wait_for_drain(timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = main.event_dispatcher.stats()
+        if stats['queue_depth'] == 0 and stats['enqueued'] <= stats['processed'] + stats['failed']:
+            return
+        time.sleep(0.01)
+
+
+def play_full_game(index):
+    client = main.app.test_client()
+    user_id = f"Ubench{index:08d}"
+    for event in (text_event(user_id, "開始遊戲"), text_event(user_id, f"玩家{index}"),
+                  text_event(user_id, "A"), text_event(user_id, "B"), text_event(user_id, "C"),
+                  image_event(user_id), text_event(user_id, "我已拍照打卡完畢"),
+                  text_event(user_id, "兌換獎項"), text_event(user_id, "PASS")):
+        post(client, event)
+
+
+def leaderboard_tap(index):
+    post(main.app.test_client(), text_event(f"Ustorm{index:08d}", "排行榜"))
+
+
+def run_phase(name, func, count):
+    started = time.perf_counter()
+    output = contextlib.nullcontext() if ARGS.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ARGS.concurrency) as pool:
+            list(pool.map(func, range(count)))
+        wait_for_drain()
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {count} 組，耗時 {elapsed:.2f} 秒")
+    return elapsed
+
+
+def report(elapsed, events, worksheet, line_api):
+    ms = lambda seconds: f"{seconds * 1000:8.1f}"
+    print()
+    print(f"總事件數 {events}，總耗時 {elapsed:.2f} 秒，吞吐量 {events / elapsed:.1f} events/s")
+    print(f"/callback HTTP 延遲 (ms)  p50 {ms(percentile(recorder.http_latency, 50))}  "
+          f"p95 {ms(percentile(recorder.http_latency, 95))}  p99 {ms(percentile(recorder.http_latency, 99))}")
+    if recorder.http_errors:
+        print(f"HTTP 錯誤: {dict(recorder.http_errors)}")
+    print(f"處理失敗的事件: {recorder.failed}，LINE 回覆次數: {line_api.replies}，Sheets 配額錯誤: {worksheet.quota_errors}")
+    print()
+    print(f"{'指令':<14}{'次數':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'Sheets/次':>12}  呼叫明細")
+    for command in sorted(set(recorder.handler_latency) | set(worksheet.calls)):
+        latencies = recorder.handler_latency.get(command, [])
+        calls = worksheet.calls.get(command, collections.Counter())
+        per_command = sum(calls.values()) / len(latencies) if latencies else float(sum(calls.values()))
+        print(f"{command:<14}{len(latencies):>8}{ms(percentile(latencies, 50)):>10}{ms(percentile(latencies, 95)):>10}"
+              f"{ms(percentile(latencies, 99)):>10}{per_command:>12.2f}  {dict(calls)}")
+    print()
+    print(f"尚未同步到工作表的資料: {main.sheet_syncer.qsize()} 筆")
+    print(f"Sheets 配額閘道: {main.sheets_gateway.stats()}")
+    print(f"打卡照片: {main.photo_archive.stats()}")
+
+
+def run():
+    worksheet = FakeWorksheet(make_existing_rows(ARGS.existing_rows), ARGS.sheets_latency / 1000, ARGS.quota_error_rate)
+    line_api = FakeLineApi(ARGS.line_latency / 1000)
+    main.sheets_supervisor.attach(worksheet)
+    main.line_api = line_api
+    main.photo_archive.line_api = line_api
+    main.dispatch_event = timed_dispatch
+    while not main.sheets_supervisor.ready:  # 等背景預熱完成，和正式環境的 /readyz 一致
+        time.sleep(0.01)
+
+    started = time.perf_counter()
+    run_phase("完整遊戲流程", play_full_game, ARGS.players)
+    run_phase("排行榜風暴", leaderboard_tap, ARGS.leaderboard_storm)
+    elapsed = time.perf_counter() - started
+
+    _current.command = BACKGROUND
+    worksheet.quota_error_rate = 0
+    main.sheet_syncer.flush_all()
+    report(elapsed, ARGS.players * 9 + ARGS.leaderboard_storm, worksheet, line_api)
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,19 +1,36 @@
 import os
 import pytz
 import datetime
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import threading
+import json
+import re
+import time
+import atexit
+import bisect
+import itertools
+import queue
+import sqlite3
+import collections
+import contextlib
+import functools
+import io
+import csv
+import concurrent.futures
+import multiprocessing
+import hashlib
+import hmac
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request, abort, jsonify, send_file
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage,
-    FlexSendMessage, ImageSendMessage, ImageMessage
-)
+from linebot.models import MessageEvent, TextMessage, ImageMessage
 
 import gspread
-# from PIL import Image, ImageDraw, ImageFont 
-# import io 
-# import requests 
-# import json 
+import report_card
+from PIL import Image
 
 app = Flask(__name__)
 
@@ -24,65 +41,1937 @@ GOOGLE_SHEET_NAME = os.environ.get('GOOGLE_SHEET_NAME')
 
 # 假設 Render Secret File 路徑
 SERVICE_ACCOUNT_FILE = '/etc/secrets/google_credentials.json'
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 對外的 https 網址 (例如 https://tsse-linebot.onrender.com)；LINE 會從這裡抓成績卡與圖片資源，
+# 未設定時不發送成績卡，圖片也維持使用 GitHub raw 網址
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+# 成績卡 process pool (spawn) 的子行程會以 __mp_main__ 的名稱重新載入本檔，子行程不啟動背景執行緒
+BACKGROUND_ENABLED = __name__ != '__mp_main__'
 
 if not all([LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GOOGLE_SHEET_NAME]):
     print("警告：請確認所有必要的環境變數已設定。")
 
-# --- Google Sheets 初始化 ---
-try:
+# ====== 監控指標 (Prometheus 文字格式，由 /metrics 輸出) ======
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 事件處理超過這個毫秒數就印出慢請求紀錄，0 代表關閉
+SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 0))
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                yield f"{self.name}{_format_labels(self.label_names, label_values)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {} # label_values -> [各 bucket 計數..., 總和, 次數]
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    yield f"{self.name}_bucket{_format_labels(self.label_names, label_values, [('le', bound)])} {cumulative}"
+                yield f"{self.name}_bucket{_format_labels(self.label_names, label_values, [('le', '+Inf')])} {series[-1]}"
+                yield f"{self.name}_sum{_format_labels(self.label_names, label_values)} {series[-2]}"
+                yield f"{self.name}_count{_format_labels(self.label_names, label_values)} {series[-1]}"
+
+class Gauge:
+    """讀取時才呼叫 func 取得目前的值 (例如 len(user_states))。"""
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            yield f"{self.name} {self.func()}"
+        except Exception as e:
+            print(f"讀取指標 {self.name} 失敗: {e}")
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=()):
+        return self.register(Histogram(name, help_text, label_names))
+
+    def gauge(self, name, help_text, func):
+        return self.register(Gauge(name, help_text, func))
+
+    def render(self):
+        return '\n'.join(line for metric in self._metrics for line in metric.collect()) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram('linebot_handler_seconds', "各指令 / 遊戲階段的事件處理時間", ('command',))
+SLOW_REQUESTS = metrics.counter('linebot_slow_requests_total', "超過 SLOW_REQUEST_THRESHOLD_MS 的事件數", ('command',))
+SHEETS_CALLS = metrics.counter('linebot_sheets_calls_total', "Google Sheets API 呼叫次數", ('method',))
+SHEETS_ERRORS = metrics.counter('linebot_sheets_errors_total', "Google Sheets API 呼叫失敗次數", ('method',))
+SHEETS_LATENCY = metrics.histogram('linebot_sheets_seconds', "Google Sheets API 呼叫時間", ('method',))
+LINE_REPLY_LATENCY = metrics.histogram('linebot_line_reply_seconds', "LINE reply API 呼叫時間")
+LINE_REPLY_ERRORS = metrics.counter('linebot_line_reply_errors_total', "LINE reply API 失敗次數", ('status',))
+
+# ====== Google Sheets 閘道 (配額控管 + 合併重複讀取) ======
+# 所有 worksheet 呼叫都經過這裡：讀寫各用一個 token bucket 對齊 Sheets API 每分鐘配額，
+# 同時間內完全相同的讀取只發出一次 (singleflight)，配額不足時排隊等到期限為止而不是直接失敗。
+SHEETS_READS_PER_MINUTE = float(os.environ.get('SHEETS_READS_PER_MINUTE', 60))
+SHEETS_WRITES_PER_MINUTE = float(os.environ.get('SHEETS_WRITES_PER_MINUTE', 60))
+SHEETS_BURST = int(os.environ.get('SHEETS_BURST', 10))
+SHEETS_QUEUE_DEADLINE = float(os.environ.get('SHEETS_QUEUE_DEADLINE', 10))  # 秒
+
+SHEETS_WRITE_METHODS = frozenset((
+    'append_row', 'append_rows', 'insert_row', 'insert_rows', 'update', 'update_acell', 'update_cell',
+    'update_cells', 'batch_update', 'batch_clear', 'clear', 'delete_rows', 'delete_row', 'resize',
+    'add_worksheet', 'del_worksheet',
+))
+
+SHEETS_COALESCED = metrics.counter('linebot_sheets_coalesced_total', "與進行中的相同讀取合併而省下的呼叫數", ('method',))
+SHEETS_THROTTLED = metrics.counter('linebot_sheets_throttled_total', "因配額不足而排隊等待的呼叫數", ('kind',))
+SHEETS_QUOTA_TIMEOUTS = metrics.counter('linebot_sheets_quota_timeouts_total', "排隊超過期限而放棄的呼叫數", ('kind',))
+SHEETS_QUOTA_RETRIES = metrics.counter('linebot_sheets_quota_retries_total', "收到 429 後在期限內重試的次數", ('method',))
+
+class SheetsQuotaExceeded(Exception):
+    """在 SHEETS_QUEUE_DEADLINE 內仍取不到配額。"""
+
+class TokenBucket:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline):
+        """取得一個 token；需要等待時回傳等待秒數，超過期限則回傳 None。"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return None
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self):
+        """收到 429 時清空 token，讓後面的呼叫一起放慢。"""
+        with self._lock:
+            self.tokens = min(self.tokens, 0.0)
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """相同 key 的呼叫同時間只執行一次，其餘呼叫等待並共用結果 (結果請當作唯讀)。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        """回傳 (結果, 是否為合併的呼叫)。"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = func()
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+class SheetsGateway:
+    def __init__(self, reads_per_minute, writes_per_minute, burst, deadline):
+        self.buckets = {'read': TokenBucket(reads_per_minute, burst), 'write': TokenBucket(writes_per_minute, burst)}
+        self.deadline = deadline
+        self.flights = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def wrap(self, worksheet):
+        return GatewayWorksheet(self, worksheet)
+
+    def call(self, owner, name, func, args, kwargs):
+        kind = 'write' if name in SHEETS_WRITE_METHODS else 'read'
+        if kind == 'write':
+            return self._call_with_quota(name, kind, func, args, kwargs)
+        key = (owner, name, repr(args), repr(sorted(kwargs.items())))
+        result, coalesced = self.flights.do(key, lambda: self._call_with_quota(name, kind, func, args, kwargs))
+        if coalesced:
+            SHEETS_COALESCED.inc(name)
+            self._count('coalesced')
+        return result
+
+    def _call_with_quota(self, name, kind, func, args, kwargs):
+        bucket = self.buckets[kind]
+        deadline = time.monotonic() + self.deadline
+        while True:
+            waited = bucket.acquire(deadline)
+            if waited is None:
+                SHEETS_QUOTA_TIMEOUTS.inc(kind)
+                self._count(f'{kind}_timeouts')
+                raise SheetsQuotaExceeded(f"Sheets {kind} 配額在 {self.deadline} 秒內仍不足 ({name})")
+            if waited:
+                SHEETS_THROTTLED.inc(kind)
+                self._count(f'{kind}_throttled')
+                self._count(f'{kind}_wait_seconds', waited)
+            self._count(f'{kind}_calls')
+            SHEETS_CALLS.inc(name)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                SHEETS_ERRORS.inc(name)
+                # 429：配額用完，清空 bucket 後在期限內排隊重試
+                if getattr(getattr(e, 'response', None), 'status_code', None) != 429:
+                    raise
+                bucket.penalize()
+                SHEETS_QUOTA_RETRIES.inc(name)
+                self._count(f'{kind}_quota_errors')
+            except Exception:
+                SHEETS_ERRORS.inc(name)
+                raise
+            finally:
+                SHEETS_LATENCY.observe(time.perf_counter() - started, name)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        for kind, bucket in self.buckets.items():
+            stats[f'{kind}_tokens_available'] = round(bucket.available(), 2)
+            stats[f'{kind}_per_minute'] = bucket.rate * 60
+        return stats
+
+class GatewayWorksheet:
+    """包住 gspread 的 Worksheet，每個方法呼叫 (get_all_values、append_rows…) 都經過閘道並計數計時。"""
+    def __init__(self, gateway, worksheet):
+        self._gateway = gateway
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._gateway.call(id(self._worksheet), name, attr, args, kwargs)
+        return call
+
+sheets_gateway = SheetsGateway(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE, SHEETS_BURST, SHEETS_QUEUE_DEADLINE)
+
+# ====== Google Sheets 連線 (背景連線 + 自動重連) ======
+# 啟動時不等待 Google Sheets：app 立即建立，連線與快取預熱都在背景執行緒完成
+SHEETS_CONNECT_MAX_BACKOFF = float(os.environ.get('SHEETS_CONNECT_MAX_BACKOFF', 60))
+# 同步連續失敗幾次後重新建立連線 (例如憑證過期)
+SHEETS_RECONNECT_AFTER_FAILURES = int(os.environ.get('SHEETS_RECONNECT_AFTER_FAILURES', 3))
+
+worksheet = None  # 連線成功前為 None；這段期間的成績仍先寫進本機資料庫
+
+def connect_worksheet():
     gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
     sh = gc.open(GOOGLE_SHEET_NAME)
-    worksheet = sh.sheet1
-    print("成功連接 Google Sheet")
-except Exception as e:
-    worksheet = None
-    print(f"Google Sheet 連接失敗: {e}")
+    return sh.sheet1
+
+class SheetsSupervisor:
+    """
+    背景執行緒：連接 Google Sheets，失敗時以指數退避重試；
+    接著預熱本機資料庫與排行榜，完成後 /readyz 才回報就緒。
+    之後閒置等待，直到同步連續失敗而被要求重新連線。
+    """
+    def __init__(self, connect, max_backoff):
+        self.connect = connect
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.warmed = False
+        self.failures = 0
+        self.last_error = None
+        self._need_connect = True
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def attach(self, ws):
+        """換上新的 worksheet (背景連線成功時，或由外部直接注入)；一律包上配額閘道。"""
+        global worksheet
+        worksheet = sheets_gateway.wrap(ws)
+        self.connected = True
+        self._need_connect = False
+        self._wakeup.set()
+
+    def request_reconnect(self, reason):
+        if not self._need_connect:
+            print(f"Google Sheet 連線異常，準備重新連線: {reason}")
+            self.connected = False
+            self._need_connect = True
+            self._wakeup.set()
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+    @property
+    def ready(self):
+        return self.warmed
+
+    def degraded_reasons(self):
+        reasons = []
+        if not self.connected:
+            reasons.append('sheets_disconnected')
+        if sheet_syncer.consecutive_failures:
+            reasons.append('sheet_sync_failing')
+        return reasons
+
+    def _step(self):
+        """執行一輪連線與預熱；全部完成時回傳 True。"""
+        if self._need_connect:
+            try:
+                self.attach(self.connect())
+                self.last_error = None
+                print("成功連接 Google Sheet")
+            except Exception as e:
+                self.last_error = f"connect: {e}"
+                print(f"Google Sheet 連接失敗: {e}")
+        if not self.warmed:
+            try:
+                # 本機資料庫若已匯入過，不必等 Google Sheets 也能就緒
+                if ensure_storage():
+                    resync_leaderboard()
+                    self.warmed = True
+                    print("本機資料庫與排行榜載入完成")
+            except Exception as e:
+                self.last_error = f"warm-up: {e}"
+                print(f"本機資料庫載入失敗，稍後重試: {e}")
+        return self.warmed and not self._need_connect
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            if self._step():
+                self.failures = 0
+                self._wakeup.wait()
+            else:
+                self.failures += 1
+                self._wakeup.wait(min(self.max_backoff, 2 ** self.failures))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sheets-supervisor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def stats(self):
+        return {'ready': self.ready, 'sheets_connected': self.connected, 'degraded': bool(self.degraded_reasons()),
+                'degraded_reasons': self.degraded_reasons(), 'connect_failures': self.failures, 'last_error': self.last_error}
+
+sheets_supervisor = SheetsSupervisor(connect_worksheet, SHEETS_CONNECT_MAX_BACKOFF)
+
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+
+# ====== LINE 回覆 (連線池 + 預先序列化的訊息) ======
+LINE_API_POOL_SIZE = int(os.environ.get('LINE_API_POOL_SIZE', 16))
+LINE_API_CONNECT_TIMEOUT = float(os.environ.get('LINE_API_CONNECT_TIMEOUT', 3))
+LINE_API_READ_TIMEOUT = float(os.environ.get('LINE_API_READ_TIMEOUT', 10))
+LINE_API_RETRIES = int(os.environ.get('LINE_API_RETRIES', 2))
+
+def _dumps(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+@functools.lru_cache(maxsize=512)
+def text_message(text):
+    return _dumps({"type": "text", "text": text}).encode('utf-8')
+
+def image_message(original_content_url, preview_image_url=None):
+    return _dumps(self_hosted({"type": "image", "originalContentUrl": original_content_url,
+                               "previewImageUrl": preview_image_url or original_content_url})).encode('utf-8')
+
+def flex_message(alt_text, contents):
+    return _dumps(self_hosted({"type": "flex", "altText": alt_text, "contents": contents})).encode('utf-8')
+
+class FlexTemplate:
+    """
+    含有 "{{欄位}}" 佔位字串的 Flex 訊息，啟動時先序列化並切成片段，
+    呼叫 render() 時只需把欄位值接回去，不必重建整個字典。
+    """
+    PLACEHOLDER = re.compile(r'"\{\{(\w+)\}\}"')
+
+    def __init__(self, alt_text, contents):
+        self._parts = self.PLACEHOLDER.split(flex_message(alt_text, contents).decode('utf-8'))
+
+    def render(self, **values):
+        # 切出來的片段：偶數位置是原樣字串，奇數位置是欄位名稱
+        return ''.join(part if i % 2 == 0 else _dumps(values[part])
+                       for i, part in enumerate(self._parts)).encode('utf-8')
+
+class LineApiError(Exception):
+    pass
+
+class LineApiClient:
+    """
+    以 keep-alive 的 requests.Session 呼叫 Messaging API，連線池大小與工作執行緒相當，
+    訊息已是序列化好的 JSON bytes，回覆時不會重新組模型物件或重新連線。
+    """
+    REPLY_URL = 'https://api.line.me/v2/bot/message/reply'
+    CONTENT_URL = 'https://api-data.line.me/v2/bot/message/{message_id}/content'
+
+    def __init__(self, access_token, pool_size, connect_timeout, read_timeout, retries):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json; charset=utf-8',
+        })
+        # 回覆權杖只能用一次：只重試「請求還沒送出」的連線失敗。讀取逾時或 5xx 時 LINE 可能已經送出回覆，
+        # 重送只會因權杖已使用而得到 400
+        reply_retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=0.3,
+                            allowed_methods=frozenset(['POST']), raise_on_status=False)
+        self.session.mount('https://api.line.me/', HTTPAdapter(pool_maxsize=pool_size, max_retries=reply_retry))
+        # 取得圖片內容是冪等的 GET，逾時與 5xx 都可以重試
+        content_retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                              allowed_methods=frozenset(['GET']), raise_on_status=False)
+        self.session.mount('https://api-data.line.me/', HTTPAdapter(pool_maxsize=pool_size, max_retries=content_retry))
+
+    def reply(self, reply_token, *messages):
+        body = b'{"replyToken":' + _dumps(reply_token).encode('utf-8') + b',"messages":[' + b','.join(messages) + b']}'
+        try:
+            with LINE_REPLY_LATENCY.time():
+                response = self.session.post(self.REPLY_URL, data=body, timeout=self.timeout)
+        except requests.RequestException:
+            LINE_REPLY_ERRORS.inc('connection')
+            raise
+        if response.status_code != 200:
+            LINE_REPLY_ERRORS.inc(str(response.status_code))
+            raise LineApiError(f"LINE 回覆失敗 ({response.status_code}): {response.text}")
+
+    def open_content(self, message_id):
+        """以串流方式取得使用者傳來的圖片內容；呼叫端讀完後要 close()。"""
+        response = self.session.get(self.CONTENT_URL.format(message_id=message_id), stream=True, timeout=self.timeout)
+        if response.status_code != 200:
+            response.close()
+            raise LineApiError(f"LINE 取得訊息內容失敗 ({response.status_code})")
+        return response
+
+line_api = LineApiClient(LINE_CHANNEL_ACCESS_TOKEN, LINE_API_POOL_SIZE, LINE_API_CONNECT_TIMEOUT,
+                         LINE_API_READ_TIMEOUT, LINE_API_RETRIES)
+
+# ====== 圖片資源 (自架、重新壓縮並產生預覽縮圖) ======
+# 原本所有圖片都直接指向 GitHub raw，原圖與預覽圖同一個大檔，而且會被 GitHub 限流；
+# 設定 PUBLIC_BASE_URL 後，repo 內的圖片改由本服務的 /assets 提供：
+# 原圖縮到 ASSET_MAX_SIZE 並重新壓縮，預覽圖縮到 ASSET_PREVIEW_SIZE，檔名含內容雜湊，可永久快取
+ASSET_DIR = os.environ.get('ASSET_DIR', BASE_DIR)
+ASSET_CACHE_DIR = os.environ.get('ASSET_CACHE_DIR', os.path.join(BASE_DIR, 'asset_cache'))
+ASSET_MAX_SIZE = int(os.environ.get('ASSET_MAX_SIZE', 1600))
+ASSET_PREVIEW_SIZE = int(os.environ.get('ASSET_PREVIEW_SIZE', 240))
+ASSET_QUALITY = int(os.environ.get('ASSET_QUALITY', 82))
+ASSET_PREVIEW_QUALITY = int(os.environ.get('ASSET_PREVIEW_QUALITY', 70))
+ASSET_SOURCE_URL_PREFIX = 'https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/'
+ASSET_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ASSET_EXCLUDE = frozenset(['report_card_template.jpg'])
+
+class AssetStore:
+    """
+    啟動時只掃描檔案並計算雜湊 (決定網址)，實際縮圖在背景或第一次被請求時產生，
+    結果存在 ASSET_CACHE_DIR，重新啟動時不必再轉一次。
+    """
+    def __init__(self, source_dir, cache_dir, base_url):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.base_url = base_url
+        self.variants = {}   # 對外檔名 -> (來源路徑, 最大邊長, JPEG 品質)
+        self.by_source = {}  # 來源檔名 -> (原圖檔名, 預覽檔名)
+        self._data = {}
+        self._lock = threading.Lock()
+        for name in sorted(os.listdir(source_dir)):
+            if not name.lower().endswith(ASSET_EXTENSIONS) or name in ASSET_EXCLUDE:
+                continue
+            path = os.path.join(source_dir, name)
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read())
+            # 轉檔參數也算進雜湊，調整尺寸或品質後網址會跟著變
+            digest.update(f"{ASSET_MAX_SIZE}-{ASSET_QUALITY}-{ASSET_PREVIEW_SIZE}-{ASSET_PREVIEW_QUALITY}".encode('ascii'))
+            stem = f"{os.path.splitext(name)[0]}-{digest.hexdigest()[:12]}"
+            original, preview = f"{stem}.jpg", f"{stem}-preview.jpg"
+            self.variants[original] = (path, ASSET_MAX_SIZE, ASSET_QUALITY)
+            self.variants[preview] = (path, ASSET_PREVIEW_SIZE, ASSET_PREVIEW_QUALITY)
+            self.by_source[name] = (original, preview)
+
+    def urls(self, url):
+        """GitHub raw 網址若對應到 repo 內的圖片，回傳 (原圖網址, 預覽網址)；否則回傳 None。"""
+        if not self.base_url or not url.startswith(ASSET_SOURCE_URL_PREFIX):
+            return None
+        names = self.by_source.get(url[len(ASSET_SOURCE_URL_PREFIX):])
+        if names is None:
+            return None
+        return tuple(f"{self.base_url}/assets/{name}" for name in names)
+
+    @staticmethod
+    def _convert(path, max_size, quality):
+        with Image.open(path) as image:
+            image.load()
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # JPEG 不支援透明，鋪在白底上
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+            return buffer.getvalue()
+
+    def get(self, name):
+        """回傳轉好的 JPEG bytes：記憶體 -> 磁碟快取 -> 現場轉檔；未知的檔名回傳 None。"""
+        data = self._data.get(name)
+        if data is not None or name not in self.variants:
+            return data
+        with self._lock:
+            data = self._data.get(name)
+            if data is None:
+                cached_path = os.path.join(self.cache_dir, name)
+                try:
+                    with open(cached_path, 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    data = self._convert(*self.variants[name])
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, cached_path)
+                self._data[name] = data
+        return data
+
+    def build_all(self):
+        for name in self.variants:
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"轉換圖片 {name} 失敗: {e}")
+
+    def start(self):
+        """背景預先轉好所有圖片，LINE 第一次來抓時不必等待。"""
+        if self.base_url and self.variants:
+            threading.Thread(target=self.build_all, name='asset-builder', daemon=True).start()
+
+def self_hosted(payload):
+    """把訊息中指向 GitHub raw 的圖片網址換成 /assets：原圖用重新壓縮版，previewImageUrl 用縮圖。"""
+    if isinstance(payload, list):
+        return [self_hosted(value) for value in payload]
+    if not isinstance(payload, dict):
+        return payload
+    result = {key: self_hosted(value) for key, value in payload.items()}
+    for key in ('url', 'originalContentUrl'):
+        hosted = isinstance(payload.get(key), str) and assets.urls(payload[key])
+        if hosted:
+            result[key] = hosted[0]
+    hosted = isinstance(payload.get('previewImageUrl'), str) and assets.urls(payload['previewImageUrl'])
+    if hosted:
+        result['previewImageUrl'] = hosted[1]
+    return result
+
+assets = AssetStore(ASSET_DIR, ASSET_CACHE_DIR, PUBLIC_BASE_URL)
+if BACKGROUND_ENABLED:
+    assets.start()
 
 # ====== 使用者狀態記錄 ======
-user_states = {}
+# memory：單一程序內的 LRU/TTL 字典；sqlite：同一台主機上多個 gunicorn worker 共用
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.sqlite3')
+SESSION_TTL_SECONDS = float(os.environ.get('SESSION_TTL_SECONDS', 2 * 60 * 60))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+
+class Session:
+    """
+    單一玩家的遊戲狀態。用 __slots__ 壓低每筆佔用的記憶體，
+    並保留 state['progress'] / state.get(...) 這種字典寫法。
+    """
+    __slots__ = ('progress', 'player_info', 'name', 'start_time', 'updated_at', 'stage_started_at')
+
+    def __init__(self, progress=0, player_info=None, name=None, start_time=None, updated_at=0.0,
+                 stage_started_at=None):
+        self.progress = progress
+        self.player_info = player_info
+        self.name = name
+        self.start_time = start_time
+        self.updated_at = updated_at
+        # 進入目前關卡的時間 (epoch 秒)，用於漏斗統計的停留時間
+        self.stage_started_at = stage_started_at
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def to_json(self):
+        return json.dumps({
+            'progress': self.progress,
+            'player_info': self.player_info,
+            'name': self.name,
+            'start_time': self.start_time.isoformat() if self.start_time else None,
+            'stage_started_at': self.stage_started_at,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data, updated_at):
+        data = json.loads(data)
+        start_time = datetime.datetime.fromisoformat(data['start_time']) if data.get('start_time') else None
+        return cls(data['progress'], data['player_info'], data['name'], start_time, updated_at,
+                   data.get('stage_started_at'))
+
+class SessionStore:
+    """
+    玩家狀態的儲存介面。取出的 Session 修改後要呼叫 save() 才算數
+    (跨程序的後端不會看到記憶體中的修改)。
+    """
+    def get(self, user_id, default=None):
+        raise NotImplementedError
+
+    def save(self, user_id, session):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __setitem__(self, user_id, session):
+        self.save(user_id, session)
+
+    def __delitem__(self, user_id):
+        self.delete(user_id)
+
+class MemorySessionStore(SessionStore):
+    """程序內的 LRU 字典：超過 TTL 沒動作或超過數量上限的狀態會被淘汰。"""
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()
+
+    def _evict(self, now):
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_entries or now - session.updated_at > self.ttl_seconds:
+                del self._sessions[user_id]
+            else:
+                break
+
+    def get(self, user_id, default=None):
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return default
+            if now - session.updated_at > self.ttl_seconds:
+                del self._sessions[user_id]
+                return default
+            return session
+
+    def save(self, user_id, session):
+        now = time.time()
+        session.updated_at = now
+        with self._lock:
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            self._evict(now)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def __len__(self):
+        with self._lock:
+            self._evict(time.time())
+            return len(self._sessions)
+
+class SqliteSessionStore(SessionStore):
+    """SQLite (WAL 模式) 存放的狀態，同一台主機上的所有 gunicorn worker 都讀得到。"""
+    PURGE_EVERY = 200 # 每寫入幾次順便清掉過期的狀態
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._writes = itertools.count(1)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id, default=None):
+        row = self._conn().execute(
+            "SELECT data, updated_at FROM sessions WHERE user_id = ? AND updated_at >= ?",
+            (user_id, time.time() - self.ttl_seconds)).fetchone()
+        return Session.from_json(row[0], row[1]) if row else default
+
+    def save(self, user_id, session):
+        session.updated_at = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                     (user_id, session.to_json(), session.updated_at))
+        if next(self._writes) % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+
+    def delete(self, user_id):
+        self._conn().execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions WHERE updated_at >= ?",
+                                    (time.time() - self.ttl_seconds,)).fetchone()[0]
+
+if SESSION_BACKEND == 'sqlite':
+    user_states = SqliteSessionStore(SESSION_DB_PATH, SESSION_TTL_SECONDS)
+else:
+    user_states = MemorySessionStore(SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES)
+
+# ====== 成績資料庫 (本機 SQLite 為主，Google Sheet 為鏡像) ======
+STORAGE_DB_PATH = os.environ.get('STORAGE_DB_PATH', 'linebot.sqlite3')
+
+def _to_int(value):
+    return int(value) if value and value.isdigit() else None
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class StorageBackend:
+    """
+    成績資料的儲存介面。所有玩家、成績、兌獎的讀寫都走這裡，
+    Google Sheet 只是由 SheetSyncer 在背景同步過去的鏡像，給工作人員查看。
+    欄位順序與工作表 A–I 欄相同。
+    """
+    def is_bootstrapped(self):
+        raise NotImplementedError
+
+    def bootstrap(self, all_values, summary_values=()):
+        """以工作表現有資料 (含標頭列) 與封存摘要建立本機資料，只在第一次啟動時執行。"""
+        raise NotImplementedError
+
+    def next_player_info(self, user_id):
+        raise NotImplementedError
+
+    def has_redeemed(self, user_id):
+        raise NotImplementedError
+
+    def add_completion(self, row):
+        raise NotImplementedError
+
+    def redeem(self, user_id):
+        """原子性的兌獎 (compare-and-set)：回傳 'success'、'already_redeemed' 或 'not_found'。"""
+        raise NotImplementedError
+
+    def has_records(self):
+        raise NotImplementedError
+
+    def top_first_completions(self, limit):
+        raise NotImplementedError
+
+    def unsynced(self, limit):
+        raise NotImplementedError
+
+    def unsynced_count(self):
+        raise NotImplementedError
+
+    def mark_synced(self, record_ids, first_row_number):
+        raise NotImplementedError
+
+    def unsynced_redemptions(self, limit):
+        raise NotImplementedError
+
+    def mark_redemptions_synced(self, user_ids):
+        raise NotImplementedError
+
+    def acquire_sync_lease(self, owner, seconds):
+        raise NotImplementedError
+
+    def add_photo(self, message_id, record_key, user_id, sha256, path, size, content_type):
+        """記錄一張打卡照片；內容雜湊第一次出現時回傳 True (相同內容只存一份檔案)。"""
+        raise NotImplementedError
+
+    def photos_for(self, record_key):
+        raise NotImplementedError
+
+    def evict_photos(self, older_than, max_bytes):
+        """移除過期或超出容量的照片索引，回傳需要從磁碟刪除的檔案路徑。"""
+        raise NotImplementedError
+
+    def photo_usage(self):
+        raise NotImplementedError
+
+    def completion_by_key(self, record_key):
+        """以「編號-次數」查詢一筆通關紀錄，回傳 (姓名, 花費秒數)。"""
+        raise NotImplementedError
+
+    def claim_event(self, event_id, now):
+        """原子性地記錄一個 webhook 事件；已經記錄過 (重複事件) 時回傳 False。"""
+        raise NotImplementedError
+
+    def hot_row_stats(self):
+        """目前工作表 (熱表) 上的紀錄數、最早的通關時間與最大列號。"""
+        raise NotImplementedError
+
+    def hot_rows(self):
+        """熱表上的紀錄，依列號排序：回傳 (id, [A..I])，F欄 以兌獎帳本為準。"""
+        raise NotImplementedError
+
+    def mark_archived(self, record_ids):
+        raise NotImplementedError
+
+    def player_summary(self):
+        """
+        有封存紀錄的玩家每人一列：user_id、永久編號、封存紀錄中的最大遊玩次數、是否已兌獎、
+        首次通關的名稱 / 秒數 / 時間。只統計已封存的紀錄，熱表上的列不會在匯入時重複出現。
+        """
+        raise NotImplementedError
+
+    def import_redemptions(self, user_ids):
+        """工作人員直接在工作表 F欄 填「是」的玩家記入兌獎帳本 (已在工作表上，不需再同步)。"""
+        raise NotImplementedError
+
+    def rotation_state(self):
+        """進行中的熱表輪替 (上次中途失敗時留下)，沒有則回傳 None。"""
+        raise NotImplementedError
+
+    def begin_rotation(self, state):
+        raise NotImplementedError
+
+    def finish_rotation(self, last_row):
+        """熱表第 2..last_row 列已刪除：之後同步的紀錄列號往上移，並清除進行中的輪替。"""
+        raise NotImplementedError
+
+    def unsynced_archived_redemptions(self, limit):
+        """紀錄都已封存 (熱表上沒有列) 的玩家尚未寫回的兌獎。"""
+        raise NotImplementedError
+
+    def release_event(self, event_id):
+        raise NotImplementedError
+
+    def prune_events(self, older_than, max_entries):
+        raise NotImplementedError
+
+    def iter_completions(self, since=None, batch_size=500):
+        """依寫入順序逐批產生所有通關紀錄 (A..I 欄，F欄 以兌獎帳本為準) 加上兌獎時間，不一次載入記憶體。"""
+        raise NotImplementedError
+
+    def add_funnel(self, entered, exited, durations):
+        """把各 worker 累積的漏斗增量合併進資料庫：進入人數、離開人數與停留秒數、停留時間直方圖。"""
+        raise NotImplementedError
+
+    def funnel_snapshot(self):
+        """回傳 ({關卡: (進入, 離開, 停留秒數總和)}, {(關卡, 上界): 次數})。"""
+        raise NotImplementedError
+
+    def completion_totals(self):
+        """通關次數、通關玩家數與已兌獎玩家數。"""
+        raise NotImplementedError
+
+class SqliteBackend(StorageBackend):
+    """
+    以 SQLite (WAL 模式) 作為系統紀錄，同一台主機上的 gunicorn worker 共用同一個檔案。
+    E欄(user_id) 與 首次通關時間 都有索引，熱路徑上的查詢只需幾毫秒。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS completions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_key TEXT NOT NULL,
+            name TEXT,
+            completed_at TEXT,
+            duration,
+            user_id TEXT NOT NULL,
+            redeemed TEXT NOT NULL DEFAULT '否',
+            is_first TEXT,
+            player_id INTEGER,
+            play_count INTEGER,
+            synced INTEGER NOT NULL DEFAULT 0,
+            sheet_row INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_completions_user_id ON completions (user_id);
+        CREATE INDEX IF NOT EXISTS idx_completions_first ON completions (is_first, duration);
+        CREATE INDEX IF NOT EXISTS idx_completions_unsynced ON completions (synced) WHERE synced = 0;
+        CREATE INDEX IF NOT EXISTS idx_completions_record_key ON completions (record_key);
+        CREATE INDEX IF NOT EXISTS idx_completions_hot ON completions (sheet_row) WHERE sheet_row IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS players (
+            user_id TEXT PRIMARY KEY,
+            player_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS redemptions (
+            user_id TEXT PRIMARY KEY,
+            redeemed_at TEXT,
+            sheet_synced INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_redemptions_unsynced ON redemptions (sheet_synced) WHERE sheet_synced = 0;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS photo_blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_photo_blobs_created ON photo_blobs (created_at);
+        CREATE TABLE IF NOT EXISTS photos (
+            message_id TEXT PRIMARY KEY,
+            record_key TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            received_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_photos_record_key ON photos (record_key);
+        CREATE INDEX IF NOT EXISTS idx_photos_sha256 ON photos (sha256);
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            received_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_webhook_events_received ON webhook_events (received_at);
+        CREATE TABLE IF NOT EXISTS funnel_stages (
+            stage INTEGER PRIMARY KEY,
+            entered INTEGER NOT NULL DEFAULT 0,
+            exited INTEGER NOT NULL DEFAULT 0,
+            seconds_total REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS funnel_durations (
+            stage INTEGER NOT NULL,
+            le REAL NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (stage, le)
+        );
+    """
+    COLUMNS = "record_key, name, completed_at, duration, user_id, redeemed, is_first, player_id, play_count"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._bootstrapped = False
+        self._conn().executescript(self.SCHEMA)
+        self._backfill_redemptions(self._conn())
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _backfill_redemptions(conn):
+        """工作表 F欄 已是「是」的玩家直接記入兌獎帳本 (已在工作表上，不需再同步)。"""
+        conn.execute("""
+            INSERT OR IGNORE INTO redemptions (user_id, redeemed_at, sheet_synced)
+            SELECT DISTINCT user_id, NULL, 1 FROM completions WHERE redeemed = '是'
+        """)
+
+    def is_bootstrapped(self):
+        if not self._bootstrapped:
+            row = self._conn().execute("SELECT value FROM meta WHERE key = 'bootstrapped'").fetchone()
+            self._bootstrapped = row is not None
+        return self._bootstrapped
+
+    def bootstrap(self, all_values, summary_values=()):
+        with self._transaction() as conn:
+            # 其他 worker 可能已經先匯入了
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'bootstrapped'").fetchone():
+                self._bootstrapped = True
+                return
+            # 已封存的玩家：摘要中每位玩家一列，以首次通關成績建立一筆紀錄 (play_count 記最大次數)；
+            # 首次通關還在熱表上的玩家沒有任何封存紀錄 (舊版摘要會包含他們)，略過以免重複匯入
+            first_on_sheet = {row[4] for row in all_values[1:] if len(row) > 6 and row[4] and row[6].strip() == '是'}
+            archived = []
+            for row in summary_values[1:]:
+                row = row + [''] * (len(SHEET_SUMMARY_HEADER) - len(row))
+                if not row[0] or row[0] in first_on_sheet:
+                    continue
+                player_id, max_play_count = _to_int(row[1]), _to_int(row[2])
+                duration = _to_float(row[5])
+                archived.append((f"{player_id}-1", row[4], row[6], row[5] if duration is None else duration, row[0],
+                                 row[3] or '否', '是' if row[4] else '否', player_id, max_play_count))
+            conn.executemany(
+                f"INSERT INTO completions ({self.COLUMNS}, synced, sheet_row) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, NULL)",
+                archived)
+            records = []
+            for row_number, row in enumerate(all_values[1:], start=2):
+                row = row + [''] * (9 - len(row))
+                if not row[4]: # E欄
+                    continue
+                duration = _to_float(row[3])
+                records.append((row[0], row[1], row[2], row[3] if duration is None else duration, row[4],
+                                row[5] or '否', row[6].strip(), _to_int(row[7]), _to_int(row[8]), row_number))
+            conn.executemany(
+                f"INSERT INTO completions ({self.COLUMNS}, synced, sheet_row) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+                records)
+            # 封存摘要的編號優先，其次是熱表最上方的列 (findall 第一個) 的 H欄
+            conn.execute("""
+                INSERT OR IGNORE INTO players (user_id, player_id)
+                SELECT user_id, COALESCE(player_id, 0) FROM completions ORDER BY sheet_row IS NOT NULL, sheet_row
+            """)
+            self._backfill_redemptions(conn)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('bootstrapped', ?)", (str(len(records) + len(archived)),))
+        self._bootstrapped = True
+        print(f"已從 Google Sheet 匯入 {len(records)} 筆紀錄與 {len(archived)} 位已封存玩家到本機資料庫")
+
+    def next_player_info(self, user_id):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT player_id FROM players WHERE user_id = ?", (user_id,)).fetchone()
+            if row:
+                player_id = row[0]
+            else:
+                # 新玩家：依目前最大的永久編號 + 1 保留一個編號
+                player_id = conn.execute("SELECT COALESCE(MAX(player_id), 0) + 1 FROM players").fetchone()[0]
+                conn.execute("INSERT INTO players (user_id, player_id) VALUES (?, ?)", (user_id, player_id))
+            count, max_play_count = conn.execute(
+                "SELECT COUNT(*), MAX(play_count) FROM completions WHERE user_id = ?", (user_id,)).fetchone()
+        if not count:
+            return {'id': player_id, 'play_count': 1, 'is_new': True}
+        return {'id': player_id, 'play_count': (max_play_count or 0) + 1, 'is_new': False}
+
+    def has_redeemed(self, user_id):
+        return self._conn().execute("SELECT 1 FROM redemptions WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def add_completion(self, row):
+        self._conn().execute(f"INSERT INTO completions ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    def redeem(self, user_id):
+        # BEGIN IMMEDIATE 取得寫入鎖，同時按下 PASS 的兩支手機 (即使在不同 worker) 只有一支會成功
+        with self._transaction() as conn:
+            if not conn.execute("SELECT 1 FROM completions WHERE user_id = ? LIMIT 1", (user_id,)).fetchone():
+                return 'not_found'
+            redeemed_at = datetime.datetime.now(pytz.timezone('Asia/Taipei')).strftime("%Y-%m-%d %H:%M:%S")
+            inserted = conn.execute("INSERT OR IGNORE INTO redemptions (user_id, redeemed_at) VALUES (?, ?)",
+                                    (user_id, redeemed_at)).rowcount
+        return 'success' if inserted else 'already_redeemed'
+
+    def has_records(self):
+        return self._conn().execute("SELECT 1 FROM completions LIMIT 1").fetchone() is not None
+
+    def top_first_completions(self, limit):
+        return self._conn().execute("""
+            SELECT name, duration FROM completions
+            WHERE is_first = '是' AND typeof(duration) IN ('real', 'integer')
+            ORDER BY duration, id LIMIT ?
+        """, (limit,)).fetchall()
+
+    def unsynced(self, limit):
+        # 已兌獎玩家尚未同步的紀錄，F欄 直接帶「是」
+        return [(row[0], list(row[1:])) for row in self._conn().execute("""
+            SELECT c.id, c.record_key, c.name, c.completed_at, c.duration, c.user_id,
+                   CASE WHEN r.user_id IS NULL THEN c.redeemed ELSE '是' END,
+                   c.is_first, c.player_id, c.play_count
+            FROM completions c LEFT JOIN redemptions r ON r.user_id = c.user_id
+            WHERE c.synced = 0 ORDER BY c.id LIMIT ?
+        """, (limit,))]
+
+    def unsynced_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM completions WHERE synced = 0").fetchone()[0]
+
+    def mark_synced(self, record_ids, first_row_number):
+        with self._transaction() as conn:
+            for offset, record_id in enumerate(record_ids):
+                sheet_row = first_row_number + offset if first_row_number else None
+                conn.execute("UPDATE completions SET synced = 1, sheet_row = ? WHERE id = ?", (sheet_row, record_id))
+
+    def unsynced_redemptions(self, limit):
+        """
+        尚未寫回工作表的兌獎 (最多 limit 位玩家)：回傳該玩家在熱表上每一列的 (user_id, 列號)，
+        工作人員看最新一次遊玩的列也會是「是」；紀錄都還沒同步的玩家先略過。
+        """
+        return self._conn().execute("""
+            SELECT c.user_id, c.sheet_row FROM completions c
+            JOIN (
+                SELECT r.user_id FROM redemptions r
+                WHERE r.sheet_synced = 0
+                  AND EXISTS (SELECT 1 FROM completions h WHERE h.user_id = r.user_id AND h.sheet_row IS NOT NULL)
+                LIMIT ?
+            ) pending ON pending.user_id = c.user_id
+            WHERE c.sheet_row IS NOT NULL ORDER BY c.sheet_row
+        """, (limit,)).fetchall()
+
+    def mark_redemptions_synced(self, user_ids):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE redemptions SET sheet_synced = 1 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+    def acquire_sync_lease(self, owner, seconds):
+        """多個 worker 中只讓一個負責同步工作表，避免同一筆資料被 append 兩次。"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'sync_lease'").fetchone()
+            if row:
+                holder, expires_at = row[0].rsplit('|', 1)
+                if holder != owner and float(expires_at) > now:
+                    return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sync_lease', ?)", (f"{owner}|{now + seconds}",))
+            return True
+
+    def add_photo(self, message_id, record_key, user_id, sha256, path, size, content_type):
+        with self._transaction() as conn:
+            new_blob = conn.execute(
+                "INSERT OR IGNORE INTO photo_blobs (sha256, path, size, content_type, created_at) VALUES (?, ?, ?, ?, ?)",
+                (sha256, path, size, content_type, time.time())).rowcount == 1
+            conn.execute("INSERT OR REPLACE INTO photos (message_id, record_key, user_id, sha256, received_at) VALUES (?, ?, ?, ?, ?)",
+                         (message_id, record_key, user_id, sha256, time.time()))
+            return new_blob
+
+    def photos_for(self, record_key):
+        return self._conn().execute("""
+            SELECT b.path, b.content_type, p.received_at FROM photos p JOIN photo_blobs b ON b.sha256 = p.sha256
+            WHERE p.record_key = ? ORDER BY p.received_at DESC
+        """, (record_key,)).fetchall()
+
+    def evict_photos(self, older_than, max_bytes):
+        with self._transaction() as conn:
+            evicted = conn.execute("SELECT sha256, path FROM photo_blobs WHERE created_at < ?", (older_than,)).fetchall()
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM photo_blobs WHERE created_at >= ?", (older_than,)).fetchone()[0]
+            if total > max_bytes:
+                # 超過容量：由最舊的開始淘汰
+                for sha256, path, size in conn.execute(
+                        "SELECT sha256, path, size FROM photo_blobs WHERE created_at >= ? ORDER BY created_at", (older_than,)).fetchall():
+                    if total <= max_bytes:
+                        break
+                    evicted.append((sha256, path))
+                    total -= size
+            shas = [(sha256,) for sha256, _ in evicted]
+            conn.executemany("DELETE FROM photos WHERE sha256 = ?", shas)
+            conn.executemany("DELETE FROM photo_blobs WHERE sha256 = ?", shas)
+            return [path for _, path in evicted]
+
+    def photo_usage(self):
+        count, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM photo_blobs").fetchone()
+        return {'photos': count, 'bytes': total}
+
+    def completion_by_key(self, record_key):
+        row = self._conn().execute("SELECT name, duration FROM completions WHERE record_key = ? ORDER BY id LIMIT 1",
+                                   (record_key,)).fetchone()
+        return tuple(row) if row else None
+
+    def hot_row_stats(self):
+        return self._conn().execute(
+            "SELECT COUNT(*), MIN(completed_at), MAX(sheet_row) FROM completions WHERE sheet_row IS NOT NULL").fetchone()
+
+    def hot_rows(self):
+        return [(row[0], list(row[1:])) for row in self._conn().execute("""
+            SELECT c.id, c.record_key, c.name, c.completed_at, c.duration, c.user_id,
+                   CASE WHEN r.user_id IS NULL THEN c.redeemed ELSE '是' END,
+                   c.is_first, c.player_id, c.play_count
+            FROM completions c LEFT JOIN redemptions r ON r.user_id = c.user_id
+            WHERE c.sheet_row IS NOT NULL ORDER BY c.sheet_row
+        """)]
+
+    def mark_archived(self, record_ids):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE completions SET sheet_row = NULL WHERE id = ?", [(record_id,) for record_id in record_ids])
+
+    def player_summary(self):
+        # 已封存 = 已同步但不在熱表上 (synced = 1 AND sheet_row IS NULL)
+        return [list(row) for row in self._conn().execute("""
+            SELECT p.user_id, p.player_id, MAX(c.play_count), CASE WHEN r.user_id IS NULL THEN '否' ELSE '是' END,
+                   f.name, f.duration, f.completed_at
+            FROM players p
+            JOIN completions c ON c.user_id = p.user_id AND c.synced = 1 AND c.sheet_row IS NULL
+            LEFT JOIN redemptions r ON r.user_id = p.user_id
+            LEFT JOIN completions f ON f.id = (
+                SELECT id FROM completions WHERE user_id = p.user_id AND is_first = '是'
+                  AND synced = 1 AND sheet_row IS NULL ORDER BY id LIMIT 1)
+            GROUP BY p.user_id ORDER BY p.player_id
+        """)]
+
+    def import_redemptions(self, user_ids):
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT OR IGNORE INTO redemptions (user_id, redeemed_at, sheet_synced)
+                SELECT ?, NULL, 1 WHERE EXISTS (SELECT 1 FROM completions WHERE user_id = ?)
+            """, [(user_id, user_id) for user_id in user_ids])
+
+    def rotation_state(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'rotation'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def begin_rotation(self, state):
+        self._conn().execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rotation', ?)",
+                             (json.dumps(state, ensure_ascii=False),))
+
+    def finish_rotation(self, last_row):
+        with self._transaction() as conn:
+            conn.execute("UPDATE completions SET sheet_row = sheet_row - ? WHERE sheet_row > ?", (last_row - 1, last_row))
+            conn.execute("DELETE FROM meta WHERE key = 'rotation'")
+
+    def unsynced_archived_redemptions(self, limit):
+        return [row[0] for row in self._conn().execute("""
+            SELECT r.user_id FROM redemptions r
+            WHERE r.sheet_synced = 0
+              AND EXISTS (SELECT 1 FROM completions c WHERE c.user_id = r.user_id AND c.synced = 1)
+              AND NOT EXISTS (SELECT 1 FROM completions c WHERE c.user_id = r.user_id AND c.sheet_row IS NOT NULL)
+            LIMIT ?
+        """, (limit,))]
+
+    def claim_event(self, event_id, now):
+        return self._conn().execute("INSERT OR IGNORE INTO webhook_events (event_id, received_at) VALUES (?, ?)",
+                                    (event_id, now)).rowcount == 1
+
+    def release_event(self, event_id):
+        self._conn().execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def prune_events(self, older_than, max_entries):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM webhook_events WHERE received_at < ?", (older_than,))
+            conn.execute("""
+                DELETE FROM webhook_events WHERE received_at <= (
+                    SELECT received_at FROM webhook_events ORDER BY received_at DESC LIMIT 1 OFFSET ?)
+            """, (max_entries,))
+
+    def iter_completions(self, since=None, batch_size=500):
+        # 專用游標：WAL 模式下長時間的讀取不會擋住寫入
+        cursor = self._conn().cursor()
+        cursor.execute("""
+            SELECT c.record_key, c.name, c.completed_at, c.duration, c.user_id,
+                   CASE WHEN r.user_id IS NULL THEN c.redeemed ELSE '是' END,
+                   c.is_first, c.player_id, c.play_count, r.redeemed_at
+            FROM completions c LEFT JOIN redemptions r ON r.user_id = c.user_id
+            WHERE COALESCE(c.completed_at, '') >= ? ORDER BY c.id
+        """, (since or '',))
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def add_funnel(self, entered, exited, durations):
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO funnel_stages (stage, entered) VALUES (?, ?)
+                ON CONFLICT (stage) DO UPDATE SET entered = entered + excluded.entered
+            """, list(entered.items()))
+            conn.executemany("""
+                INSERT INTO funnel_stages (stage, exited, seconds_total) VALUES (?, ?, ?)
+                ON CONFLICT (stage) DO UPDATE SET exited = exited + excluded.exited,
+                                                  seconds_total = seconds_total + excluded.seconds_total
+            """, [(stage, count, seconds) for stage, (count, seconds) in exited.items()])
+            conn.executemany("""
+                INSERT INTO funnel_durations (stage, le, count) VALUES (?, ?, ?)
+                ON CONFLICT (stage, le) DO UPDATE SET count = count + excluded.count
+            """, [(stage, le, count) for (stage, le), count in durations.items()])
+
+    def funnel_snapshot(self):
+        conn = self._conn()
+        stages = {row[0]: tuple(row[1:]) for row in conn.execute(
+            "SELECT stage, entered, exited, seconds_total FROM funnel_stages")}
+        durations = {(row[0], row[1]): row[2] for row in conn.execute(
+            "SELECT stage, le, count FROM funnel_durations")}
+        return stages, durations
+
+    def completion_totals(self):
+        completions, players = self._conn().execute(
+            "SELECT COUNT(*), COUNT(DISTINCT user_id) FROM completions").fetchone()
+        redeemed = self._conn().execute("SELECT COUNT(*) FROM redemptions").fetchone()[0]
+        return {'completions': completions, 'players': players, 'redeemed': redeemed}
+
+storage = SqliteBackend(STORAGE_DB_PATH)
+
+def ensure_storage():
+    """本機資料庫第一次使用前，先讀取熱表與封存摘要匯入；無法匯入時回傳 False。"""
+    if storage.is_bootstrapped():
+        return True
+    if not worksheet:
+        return False
+    storage.bootstrap(worksheet.get_all_values(), read_summary_values())
+    return True
+
+# ====== 排行榜 (記憶體 Top-K) ======
+LEADERBOARD_SIZE = 5
+# 排行榜多久從資料庫重新同步一次 (秒)，可看到其他 worker 寫入的成績；0 代表只在啟動時載入
+LEADERBOARD_RESYNC_SECONDS = float(os.environ.get('LEADERBOARD_RESYNC_SECONDS', 30))
+
+class Leaderboard:
+    """
+    只保留最快的前 K 筆首次通關紀錄 (依時間排序的 list)。
+    啟動時從資料庫載入一次，之後由 record_completion 就地更新；
+    排行榜文字會快取起來，直到前 K 名有變動才重新產生。
+    """
+    def __init__(self, size, resync_seconds):
+        self.size = size
+        self.resync_seconds = resync_seconds
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._top = [] # (秒數, 序號, 名稱)
+        self._has_records = False
+        self._text = None
+        self._synced_at = 0
+        self.loaded = False
+
+    def load(self, records, has_records):
+        """records 為依時間排序好的 (名稱, 秒數)。"""
+        seq = itertools.count()
+        top = [(time_spent, next(seq), name) for name, time_spent in records[:self.size]]
+        with self._lock:
+            self._seq = seq
+            self._top = top
+            self._has_records = has_records
+            self._text = None
+            self._synced_at = time.monotonic()
+            self.loaded = True
+
+    def is_stale(self):
+        return bool(self.resync_seconds) and time.monotonic() - self._synced_at > self.resync_seconds
+
+    def add(self, name, time_spent):
+        with self._lock:
+            self._has_records = True
+            if len(self._top) >= self.size and time_spent >= self._top[-1][0]:
+                return
+            bisect.insort(self._top, (time_spent, next(self._seq), name))
+            del self._top[self.size:]
+            self._text = None
+
+    def mark_has_records(self):
+        with self._lock:
+            if not self._has_records:
+                self._has_records = True
+                self._text = None
+
+    def render(self):
+        with self._lock:
+            if self._text is None:
+                self._text = self._render_text()
+            return self._text
+
+    def _render_text(self):
+        if not self._has_records:
+            return "目前還沒有人完成挑戰，快來搶頭香吧！🏆"
+        if not self._top:
+            return "目前還沒有玩家首次完成挑戰！"
+
+        leaderboard_text = "🏆 積分計時排行榜 🏆\n\n"
+        rank_emojis = ["🥇", "🥈", "🥉", "⒋", "⒌"]
+
+        for i, (time_spent, _, name) in enumerate(self._top):
+            leaderboard_text += f"{rank_emojis[i]} {name} - {time_spent} 秒\n"
+
+        return leaderboard_text.strip()
+
+leaderboard = Leaderboard(LEADERBOARD_SIZE, LEADERBOARD_RESYNC_SECONDS)
+
+def resync_leaderboard():
+    """以資料庫中最快的首次通關紀錄重建排行榜 (走 is_first, duration 索引)。"""
+    leaderboard.load(storage.top_first_completions(leaderboard.size), storage.has_records())
+
+# ====== 關卡漏斗統計 (progress 轉移時增量累加) ======
+# 報表中關卡的順序：-1 輸入名稱、1~4 題目、5 通關待兌換、-2 等待兌換碼
+FUNNEL_STAGE_ORDER = (-1, 1, 2, 3, 4, 5, -2)
+# 每關停留時間直方圖的上界 (秒)，最後一格自動補上 +Inf
+FUNNEL_DURATION_BUCKETS = tuple(float(b) for b in os.environ.get('FUNNEL_DURATION_BUCKETS', '10,30,60,120,300,600,1800').split(','))
+# 各 worker 多久把累積的增量合併進資料庫一次 (秒)
+FUNNEL_FLUSH_INTERVAL = float(os.environ.get('FUNNEL_FLUSH_INTERVAL', 10))
+
+FUNNEL_ENTERED = metrics.counter('linebot_funnel_entered_total', "進入各關卡的次數", ('stage',))
+
+class FunnelStats:
+    """
+    關卡漏斗：每次 progress 轉移時，在記憶體累加「進入人數」與「上一關的停留時間」直方圖，
+    背景執行緒定期把增量合併進資料庫 (各 worker 共用)。
+    查詢時只讀幾十列彙總資料，不必掃描通關紀錄，更不會對工作表 get_all_values()。
+    """
+    def __init__(self, storage, buckets, flush_interval):
+        self.storage = storage
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self._entered = collections.Counter()
+        self._exited = collections.defaultdict(lambda: [0, 0.0]) # 關卡 -> [離開人數, 停留秒數總和]
+        self._durations = collections.Counter()                   # (關卡, 上界) -> 次數
+
+    def record(self, old_stage, new_stage, stage_started_at, now):
+        """玩家在 old_stage 停留到 now 後進入 new_stage；old_stage 為 None 代表剛開始，new_stage 為 None 代表遊戲結束。"""
+        with self._lock:
+            if old_stage is not None and stage_started_at is not None:
+                seconds = max(0.0, now - stage_started_at)
+                exited = self._exited[old_stage]
+                exited[0] += 1
+                exited[1] += seconds
+                self._durations[(old_stage, self.buckets[bisect.bisect_left(self.buckets, seconds)])] += 1
+            if new_stage is not None:
+                self._entered[new_stage] += 1
+        if new_stage is not None:
+            FUNNEL_ENTERED.inc(str(new_stage))
+
+    def flush(self):
+        """把本 worker 累積的增量寫入資料庫；失敗時放回記憶體，下次再合併。"""
+        with self._flush_lock:
+            with self._lock:
+                entered, exited, durations = self._entered, self._exited, self._durations
+                self._reset()
+            if not (entered or exited or durations):
+                return
+            try:
+                self.storage.add_funnel(dict(entered), {stage: tuple(value) for stage, value in exited.items()},
+                                        dict(durations))
+            except Exception:
+                with self._lock:
+                    self._entered.update(entered)
+                    for stage, (count, seconds) in exited.items():
+                        self._exited[stage][0] += count
+                        self._exited[stage][1] += seconds
+                    self._durations.update(durations)
+                raise
+
+    def snapshot(self):
+        """各關卡的進入 / 離開人數、相對上一關的轉換率、平均停留秒數與停留時間直方圖。"""
+        self.flush()
+        stages, durations = self.storage.funnel_snapshot()
+        order = list(FUNNEL_STAGE_ORDER) + sorted(set(stages) - set(FUNNEL_STAGE_ORDER))
+        report = []
+        previous = None
+        for stage in order:
+            entered, exited, seconds_total = stages.get(stage, (0, 0, 0.0))
+            bounds = sorted(set(self.buckets) | {le for (s, le) in durations if s == stage})
+            report.append({
+                'stage': stage,
+                'entered': entered,
+                'exited': exited,
+                # 還停在這關或中途放棄 (重新開始、閒置過期) 的人數
+                'not_advanced': max(0, entered - exited),
+                'conversion': round(entered / previous, 4) if previous else None,
+                'avg_seconds': round(seconds_total / exited, 1) if exited else None,
+                'duration_histogram': [{'le': '+Inf' if le == float('inf') else f'{le:g}',
+                                        'count': durations.get((stage, le), 0)} for le in bounds],
+            })
+            previous = entered
+        return report
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"寫入漏斗統計失敗: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='funnel-stats', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"關機前寫入漏斗統計失敗: {e}")
+
+funnel = FunnelStats(storage, FUNNEL_DURATION_BUCKETS, FUNNEL_FLUSH_INTERVAL)
+if BACKGROUND_ENABLED:
+    funnel.start()
+    atexit.register(funnel.stop)
+
+def advance(state, progress):
+    """所有 progress 轉移都經過這裡並順便更新漏斗；progress 為 None 代表遊戲結束 (狀態即將刪除)。"""
+    now = time.time()
+    old_progress = state.get('progress')
+    if progress != old_progress:
+        funnel.record(old_progress, progress, state.get('stage_started_at'), now)
+        state['stage_started_at'] = now
+    if progress is not None:
+        state['progress'] = progress
+
+# ====== 熱表輪替 (舊紀錄搬到封存工作表) ======
+# sheet1 只保留最近的紀錄：超過 SHEET_ROTATE_MAX_ROWS 列，或 (設定 SHEET_ROTATE_DAILY=1 時) 跨日後，
+# 把熱表上的紀錄整批搬到新的「封存」工作表，並重寫「摘要」工作表 (每位玩家一列)，
+# 讓重新部署時的匯入只需讀取小小的熱表與摘要
+SHEET_ROTATE_MAX_ROWS = int(os.environ.get('SHEET_ROTATE_MAX_ROWS', 1000))
+SHEET_ROTATE_DAILY = os.environ.get('SHEET_ROTATE_DAILY', '0') == '1'
+SHEET_SUMMARY_TITLE = os.environ.get('SHEET_SUMMARY_TITLE', '摘要')
+SHEET_SUMMARY_HEADER = ['LINE user_id', '永久編號', '最大遊玩次數', '是否已兌獎', '首次通關名稱', '首次通關秒數', '首次通關時間']
+
+def read_summary_values():
+    """讀取摘要工作表；還沒有輪替過 (或無法取得試算表) 時回傳空串列。"""
+    spreadsheet = getattr(worksheet, 'spreadsheet', None)
+    if spreadsheet is None:
+        return []
+    try:
+        return sheets_gateway.wrap(sheets_gateway.wrap(spreadsheet).worksheet(SHEET_SUMMARY_TITLE)).get_all_values()
+    except gspread.exceptions.WorksheetNotFound:
+        return []
+
+class SheetRotator:
+    """由持有同步租約的 SheetSyncer 呼叫，所以同一時間只有一個 worker 會輪替。"""
+    def __init__(self, storage, max_rows, daily):
+        self.storage = storage
+        self.max_rows = max_rows
+        self.daily = daily
+        self.rotations = 0
+
+    @staticmethod
+    def spreadsheet():
+        spreadsheet = getattr(worksheet, 'spreadsheet', None)
+        return sheets_gateway.wrap(spreadsheet) if spreadsheet is not None else None
+
+    def due(self):
+        if self.storage.rotation_state() is not None:
+            return True
+        count, oldest, _ = self.storage.hot_row_stats()
+        if not count:
+            return False
+        if count >= self.max_rows:
+            return True
+        today = datetime.datetime.now(pytz.timezone('Asia/Taipei')).strftime("%Y-%m-%d")
+        return self.daily and bool(oldest) and oldest[:10] < today
+
+    def write_summary(self, spreadsheet):
+        """以本機資料庫重寫摘要工作表 (只含已封存的玩家)。"""
+        rows = self.storage.player_summary()
+        try:
+            summary = spreadsheet.worksheet(SHEET_SUMMARY_TITLE)
+        except gspread.exceptions.WorksheetNotFound:
+            summary = spreadsheet.add_worksheet(title=SHEET_SUMMARY_TITLE, rows=len(rows) + 1, cols=len(SHEET_SUMMARY_HEADER))
+        summary = sheets_gateway.wrap(summary)
+        # 玩家只會增加：先把表格撐到剛好的大小 (超出格線的 update 會被拒絕)，再整塊覆寫
+        summary.resize(rows=len(rows) + 1, cols=len(SHEET_SUMMARY_HEADER))
+        summary.update([SHEET_SUMMARY_HEADER] + rows, 'A1')
+
+    def _plan(self):
+        """決定這次要封存的範圍，並讀取熱表上實際的內容 (含工作人員手動輸入或修改的列)。"""
+        hot = self.storage.hot_rows()
+        if not hot:
+            return None
+        last_row = self.storage.hot_row_stats()[2]
+        values = worksheet.get_values(f"1:{last_row}")
+        # 工作人員在 F欄 標記已兌獎的玩家也記入帳本，重新匯入時才不會遺失
+        self.storage.import_redemptions({row[4] for row in values[1:] if len(row) > 5 and row[4] and row[5] == '是'})
+        first_date, last_date = hot[0][1][2][:10], hot[-1][1][2][:10]
+        stamp = datetime.datetime.now(pytz.timezone('Asia/Taipei')).strftime("%H%M%S")
+        return {
+            'title': f"封存 {first_date}~{last_date} {stamp}",
+            'values': values,
+            'record_ids': [record_id for record_id, _ in hot],
+            'last_row': last_row,
+        }
+
+    def rotate(self):
+        """
+        每一步都可以重複執行：計畫先存進資料庫，中途失敗時下次 flush 沿用同一個封存表繼續，
+        不會一再新增重複的封存表。順序是 1. 寫封存表 2. 更新本機列號與摘要 3. 最後才刪除熱表上的列。
+        """
+        spreadsheet = self.spreadsheet()
+        if spreadsheet is None:
+            return 0
+        state = self.storage.rotation_state()
+        if state is None:
+            state = self._plan()
+            if state is None:
+                return 0
+            self.storage.begin_rotation(state)
+        title, values, last_row = state['title'], state['values'], state['last_row']
+        try:
+            archive = spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            archive = spreadsheet.add_worksheet(title=title, rows=max(len(values), 1),
+                                                cols=max([9] + [len(row) for row in values]))
+        sheets_gateway.wrap(archive).update(values, 'A1')
+        self.storage.mark_archived(state['record_ids'])
+        archived_redemptions = self.storage.unsynced_archived_redemptions(-1)
+        self.write_summary(spreadsheet)
+        self.storage.mark_redemptions_synced(archived_redemptions)
+        # 只有第 2 列仍是這批的第一列時才刪除：上次可能已經刪除成功，只是沒來得及記錄
+        first_row = values[1] if len(values) > 1 else []
+        if _trim_row(worksheet.row_values(2)) == _trim_row(first_row):
+            worksheet.delete_rows(2, last_row)
+        self.storage.finish_rotation(last_row)
+        self.rotations += 1
+        print(f"已將熱表第 2~{last_row} 列封存到「{title}」")
+        return len(values) - 1
+
+def _trim_row(row):
+    """去掉列尾的空白儲存格 (Sheets API 回傳時不會包含)。"""
+    row = [str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+sheet_rotator = SheetRotator(storage, SHEET_ROTATE_MAX_ROWS, SHEET_ROTATE_DAILY)
+
+# ====== 工作表同步 (write-behind) ======
+COMPLETION_BATCH_SIZE = int(os.environ.get('COMPLETION_BATCH_SIZE', 20))
+COMPLETION_FLUSH_INTERVAL = float(os.environ.get('COMPLETION_FLUSH_INTERVAL', 5))
+COMPLETION_MAX_BACKOFF = float(os.environ.get('COMPLETION_MAX_BACKOFF', 60))
+
+class SheetSyncer:
+    """
+    背景執行緒：把本機資料庫中尚未同步的通關紀錄與兌獎，每隔一段時間或累積 N 筆時，
+    以一次 append_rows / batch_update 批次鏡像到工作表，讓工作人員可以繼續使用試算表。
+    多個 worker 之間以資料庫中的租約決定由誰負責同步。
+    """
+    def __init__(self, storage, batch_size, flush_interval, max_backoff):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.lease_seconds = max(30, flush_interval * 3)
+        self.owner = f"{os.getpid()}-{id(self)}"
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._added = 0
+        self.consecutive_failures = 0
+
+    def notify(self):
+        """有新紀錄寫入時呼叫；累積到一批就提早喚醒同步執行緒。"""
+        self._added += 1
+        if self._added >= self.batch_size:
+            self._added = 0
+            self._wakeup.set()
+
+    def qsize(self):
+        return self.storage.unsynced_count()
+
+    def flush(self):
+        """同步一批資料，回傳寫入筆數；失敗時丟出例外，資料保留在資料庫中等下次重試。"""
+        with self._flush_lock:
+            if not worksheet or not self.storage.acquire_sync_lease(self.owner, self.lease_seconds):
+                return 0
+            # 上次的輪替只做了一半 (例如刪除列已經生效、回應卻逾時) 時，本機列號可能已經偏移：
+            # 先把輪替做完，才能 append 或依列號寫 F欄；輪替失敗就整批留到下次
+            if self.storage.rotation_state() is not None:
+                sheet_rotator.rotate()
+                if self.storage.rotation_state() is not None:
+                    return 0
+            written = 0
+            batch = self.storage.unsynced(self.batch_size)
+            if batch:
+                response = worksheet.append_rows([row for _, row in batch])
+                match = re.search(r'![A-Z]+(\d+)', (response or {}).get('updates', {}).get('updatedRange', ''))
+                self.storage.mark_synced([record_id for record_id, _ in batch], int(match.group(1)) if match else None)
+                written += len(batch)
+            # 兌獎帳本以一次 batch_update 寫回 F欄
+            redemptions = self.storage.unsynced_redemptions(self.batch_size)
+            if redemptions:
+                worksheet.batch_update([{'range': f'F{row}', 'values': [['是']]} for _, row in redemptions])
+                user_ids = list(dict.fromkeys(user_id for user_id, _ in redemptions))
+                self.storage.mark_redemptions_synced(user_ids)
+                written += len(user_ids)
+            # 紀錄都已封存的玩家兌獎：F欄 已不在熱表上，改為重寫摘要
+            archived_redemptions = self.storage.unsynced_archived_redemptions(self.batch_size)
+            spreadsheet = sheet_rotator.spreadsheet()
+            if archived_redemptions and spreadsheet is not None:
+                sheet_rotator.write_summary(spreadsheet)
+                self.storage.mark_redemptions_synced(archived_redemptions)
+                written += len(archived_redemptions)
+            if sheet_rotator.due():
+                try:
+                    sheet_rotator.rotate()
+                except Exception as e:
+                    # 輪替失敗不影響新紀錄的同步，下次 flush 再試
+                    print(f"熱表輪替失敗: {e}")
+            return written
+
+    def flush_all(self):
+        while self.flush():
+            pass
+
+    def _run(self):
+        backoff = 0
+        while not self._stopped.is_set():
+            self._wakeup.wait(backoff or self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush_all()
+                self.consecutive_failures = 0
+                backoff = 0
+            except Exception as e:
+                self.consecutive_failures += 1
+                backoff = min(self.max_backoff, 2 ** self.consecutive_failures)
+                # 配額不足只需等待，其他錯誤連續發生時重新建立連線
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                quota_error = isinstance(e, SheetsQuotaExceeded) or status_code == 429
+                if self.consecutive_failures == SHEETS_RECONNECT_AFTER_FAILURES and not quota_error:
+                    sheets_supervisor.request_reconnect(e)
+                print(f"同步 Google Sheet 失敗 (第 {self.consecutive_failures} 次)，{backoff} 秒後重試: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sheet-syncer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """關機時呼叫：停止背景執行緒並盡量把剩下的資料同步完。"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush_all()
+        except Exception as e:
+            print(f"關機前同步失敗，{self.qsize()} 筆資料保留在 {self.storage.path}: {e}")
+
+sheet_syncer = SheetSyncer(storage, COMPLETION_BATCH_SIZE, COMPLETION_FLUSH_INTERVAL, COMPLETION_MAX_BACKOFF)
+if BACKGROUND_ENABLED:
+    sheet_syncer.start()
+    atexit.register(sheet_syncer.stop)
+
+if BACKGROUND_ENABLED:
+    sheets_supervisor.start()
+    atexit.register(sheets_supervisor.stop)
+
+# ====== 個人成績卡 (process pool 繪製 + LRU 快取) ======
+REPORT_CARD_TEMPLATE = os.path.join(BASE_DIR, 'report_card_template.jpg')
+# 含中文字的 TTF/OTF 路徑，例如 NotoSansTC-Bold.otf；沒有設定 (或檔案不存在) 時不發送成績卡，避免中文變成方塊
+REPORT_CARD_FONT = os.environ.get('REPORT_CARD_FONT', '')
+# 成績卡網址的簽章金鑰 (預設沿用 LINE_CHANNEL_SECRET)，沒有簽章就無法依序列舉其他玩家的成績卡
+REPORT_CARD_SECRET = os.environ.get('REPORT_CARD_SECRET') or LINE_CHANNEL_SECRET or ''
+REPORT_CARD_SIZE = int(os.environ.get('REPORT_CARD_SIZE', 1024))
+REPORT_CARD_PREVIEW_SIZE = int(os.environ.get('REPORT_CARD_PREVIEW_SIZE', 240))
+REPORT_CARD_WORKERS = int(os.environ.get('REPORT_CARD_WORKERS', 2))
+REPORT_CARD_CACHE_SIZE = int(os.environ.get('REPORT_CARD_CACHE_SIZE', 256))
+REPORT_CARD_TIMEOUT = float(os.environ.get('REPORT_CARD_TIMEOUT', 10))
+
+REPORT_CARD_RENDERS = metrics.counter('linebot_report_card_renders_total', "成績卡繪製次數", ('result',))
+REPORT_CARD_CACHE = metrics.counter('linebot_report_card_cache_total', "成績卡快取命中 / 未命中", ('result',))
+
+class ReportCardRenderer:
+    """
+    成績卡在通關時就送進 process pool 繪製，不佔用 webhook 執行緒；
+    子行程啟動時只解碼一次模板與字型。繪製結果以 (玩家編號, 次數) 為 key 放在 LRU 快取，
+    LINE 之後來抓圖片時直接回傳；快取沒有 (例如由另一個 worker 接到請求) 才從資料庫補資料重畫。
+    """
+    def __init__(self, storage, workers, cache_size):
+        self.storage = storage
+        self.workers = workers
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # (player_id, play_count) -> Future[(原圖, 預覽圖)]
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=report_card.init_worker,
+                initargs=(REPORT_CARD_TEMPLATE, REPORT_CARD_FONT, REPORT_CARD_SIZE, REPORT_CARD_PREVIEW_SIZE))
+        return self._pool
+
+    def submit(self, player_id, play_count, name, duration):
+        key = (int(player_id), int(play_count))
+        with self._lock:
+            future = self._cache.get(key)
+            if future is not None:
+                self._cache.move_to_end(key)
+                REPORT_CARD_CACHE.inc('hit')
+                return future
+            REPORT_CARD_CACHE.inc('miss')
+            future = self._executor().submit(report_card.render, name, f"{key[0]}-{key[1]}", duration)
+            self._cache[key] = future
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.add_done_callback(lambda f: self._on_done(key, f))
+        return future
+
+    def _on_done(self, key, future):
+        if future.exception() is None:
+            REPORT_CARD_RENDERS.inc('ok')
+            return
+        REPORT_CARD_RENDERS.inc('failed')
+        print(f"繪製成績卡 {key[0]}-{key[1]} 失敗: {future.exception()}")
+        with self._lock:
+            # 失敗的結果不留在快取，下次請求會重畫；子行程異常結束時重建 process pool
+            if self._cache.get(key) is future:
+                del self._cache[key]
+            if isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+                self._pool = None
+
+    def get(self, player_id, play_count, timeout=REPORT_CARD_TIMEOUT):
+        """回傳 (原圖, 預覽圖) JPEG bytes；找不到這筆通關紀錄時回傳 None。"""
+        with self._lock:
+            future = self._cache.get((player_id, play_count))
+        if future is None:
+            completion = self.storage.completion_by_key(f"{player_id}-{play_count}")
+            if completion is None:
+                return None
+            future = self.submit(player_id, play_count, *completion)
+        return future.result(timeout)
+
+    @property
+    def enabled(self):
+        return bool(PUBLIC_BASE_URL and REPORT_CARD_SECRET and REPORT_CARD_FONT and os.path.exists(REPORT_CARD_FONT))
+
+    @staticmethod
+    def token(player_id, play_count):
+        message = f"{int(player_id)}-{int(play_count)}".encode('utf-8')
+        return hmac.new(REPORT_CARD_SECRET.encode('utf-8'), message, hashlib.sha256).hexdigest()[:32]
+
+    @classmethod
+    def verify(cls, token, player_id, play_count):
+        return bool(REPORT_CARD_SECRET) and hmac.compare_digest(token, cls.token(player_id, play_count))
+
+    @classmethod
+    def urls(cls, player_id, play_count):
+        base = f"{PUBLIC_BASE_URL}/report-card/{cls.token(player_id, play_count)}/{player_id}-{play_count}"
+        return f"{base}.jpg", f"{base}-preview.jpg"
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._cache), 'capacity': self.cache_size, 'enabled': self.enabled}
+
+report_cards = ReportCardRenderer(storage, REPORT_CARD_WORKERS, REPORT_CARD_CACHE_SIZE)
+if PUBLIC_BASE_URL and not report_cards.enabled and BACKGROUND_ENABLED:
+    print("警告：未設定可用的 REPORT_CARD_FONT (含中文字的字型)，不發送個人成績卡。")
+atexit.register(report_cards.stop)
 
 # ====== 核心函式：取得玩家資訊  ======
 def get_player_info(user_id):
-    global worksheet
-    if not worksheet: return None
     try:
-        cells = worksheet.findall(user_id, in_column=5) # E欄是 LINE User ID
-        if not cells:
-            all_player_ids = worksheet.col_values(8)[1:] # H欄是玩家永久編號
-            all_player_ids_int = [int(i) for i in all_player_ids if i and i.isdigit()]
-            new_id = max(all_player_ids_int) + 1 if all_player_ids_int else 1
-            return {'id': new_id, 'play_count': 1, 'is_new': True}
-        else:
-            first_cell = cells[0]
-            permanent_id_str = worksheet.cell(first_cell.row, 8).value # H欄
-            permanent_id = int(permanent_id_str) if permanent_id_str and permanent_id_str.isdigit() else 0
-            all_play_counts = [int(worksheet.cell(c.row, 9).value) for c in cells if worksheet.cell(c.row, 9).value and worksheet.cell(c.row, 9).value.isdigit()] # I欄
-            next_play_count = max(all_play_counts) + 1 if all_play_counts else 1
-            return {'id': permanent_id, 'play_count': next_play_count, 'is_new': False}
+        if not ensure_storage(): return None
+        return storage.next_player_info(user_id)
     except Exception as e:
         print(f"獲取玩家資訊時出錯: {e}")
         return None
 
 # ====== 核心函式：寫入紀錄  ======
 def record_completion(user_id):
-    global worksheet
-    if not worksheet: return None
-    state = user_states.get(user_id, {})
-    if 'player_info' not in state: return None
+    state = user_states.get(user_id)
+    if not state or 'player_info' not in state: return None
     player_info = state['player_info']
     is_first_ever_completion = player_info['is_new']
     
     # 檢查玩家過去是否已兌獎
     has_redeemed_before = False
     try:
-        all_user_records = worksheet.findall(user_id, in_column=5) # E欄是 User ID
-        for record_cell in all_user_records:
-            if worksheet.cell(record_cell.row, 6).value == '是':
-                has_redeemed_before = True
-                break
+        has_redeemed_before = storage.has_redeemed(user_id)
     except Exception as e:
         print(f"檢查過往兌獎狀態時發生錯誤: {e}")
         has_redeemed_before = False
@@ -103,27 +1992,27 @@ def record_completion(user_id):
             player_info['id'],
             player_info['play_count']
         ]
-        worksheet.insert_row(row_to_insert, 2)
-        return {'is_first': is_first_ever_completion, 'count': player_info['play_count']}
+        storage.add_completion(row_to_insert)
+        sheet_syncer.notify()
+        if is_first_ever_completion:
+            leaderboard.add(state['name'], duration_seconds)
+        else:
+            leaderboard.mark_has_records()
+        return {'is_first': is_first_ever_completion, 'count': player_info['play_count'], 'player_id': player_info['id'],
+                'name': state['name'], 'duration': duration_seconds}
     except Exception as e:
-        print(f"寫入 Google Sheet 時發生錯誤: {e}")
+        print(f"寫入成績時發生錯誤: {e}")
         return None
 
-# ====== 核心函式：兌換獎品 (不變) ======
+# ====== 核心函式：兌換獎品 ======
 def redeem_prize(user_id):
-    global worksheet
-    if not worksheet: return None
     try:
-        cell = worksheet.find(user_id, in_column=5) # E欄是 LINE User ID
-        if not cell:
-            return 'not_found'
-        
-        # F欄是是否已兌獎
-        if worksheet.acell(f'F{cell.row}').value == '是':
-            return 'already_redeemed'
-        
-        worksheet.update_acell(f'F{cell.row}', '是')
-        return 'success'
+        if not ensure_storage(): return None
+        # 兌獎帳本上的 compare-and-set，F欄 由 SheetSyncer 批次寫回工作表
+        result = storage.redeem(user_id)
+        if result == 'success':
+            sheet_syncer.notify()
+        return result
     except Exception as e:
         print(f"兌獎時發生錯誤: {e}")
         return None
@@ -134,353 +2023,909 @@ def redeem_prize(user_id):
 
 def get_leaderboard():
     """
-    從 Google Sheet 讀取資料，產生排行榜文字。
-    使用欄位索引來讀取，避免因標頭名稱不符而出錯。
+    產生排行榜文字。
+    資料來自記憶體中的 Top-K 排行榜，只有在尚未載入或超過同步時間窗時才查詢本機資料庫。
     """
-    if not worksheet:
-        print("排行榜功能：Worksheet 未初始化。")
-        return "抱歉，排行榜功能暫時無法使用，請聯繫管理員。"
-
     try:
-        # 1. 讀取整個工作表的所有值 (除了第一行標頭)
-        all_values = worksheet.get_all_values()[1:]
+        if not ensure_storage():
+            print("排行榜功能：資料庫尚未從 Worksheet 匯入。")
+            return "抱歉，排行榜功能暫時無法使用，請聯繫管理員。"
+        if not leaderboard.loaded or leaderboard.is_stale():
+            resync_leaderboard()
+        return leaderboard.render()
 
-        if not all_values:
-            return "目前還沒有人完成挑戰，快來搶頭香吧！🏆"
+    except gspread.exceptions.APIError as e:
+        print(f"Google Sheets API 錯誤: {e}")
+        return "讀取排行榜時發生 API 錯誤，請檢查權限或稍後再試。"
+    except Exception as e:
+        print(f"產生排行榜時發生未預期的錯誤: {e}")
+        return "讀取排行榜時發生了一點小問題，請稍後再試！"
+
+# ====== 重送事件去重 (webhookEventId) ======
+# LINE 在我們回應太慢時會重送同一個事件 (deliveryContext.isRedelivery = true)，
+# 以 webhookEventId 記錄處理過的事件，重複的在進入佇列前就丟掉；紀錄存在 SQLite，所有 worker 共用
+WEBHOOK_DEDUP_WINDOW_SECONDS = float(os.environ.get('WEBHOOK_DEDUP_WINDOW_SECONDS', 24 * 60 * 60))
+WEBHOOK_DEDUP_MAX_ENTRIES = int(os.environ.get('WEBHOOK_DEDUP_MAX_ENTRIES', 100000))
+WEBHOOK_DEDUP_LOCAL_SIZE = int(os.environ.get('WEBHOOK_DEDUP_LOCAL_SIZE', 4096))
+
+WEBHOOK_DUPLICATES = metrics.counter('linebot_webhook_duplicates_total', "被丟掉的重複 webhook 事件", ('redelivery',))
+WEBHOOK_REDELIVERIES = metrics.counter('linebot_webhook_redeliveries_total', "收到 LINE 標記為重送的事件數")
+
+class WebhookDeduplicator:
+    """
+    先查本機的小型 LRU (同一個 worker 收到的重送不必碰資料庫)，
+    再以資料庫的 INSERT OR IGNORE 原子性地「認領」事件，其他 worker 收到同一事件時會認領失敗。
+    """
+    PRUNE_EVERY = 500 # 每認領幾次順便清掉超出時間窗或數量上限的紀錄
+
+    def __init__(self, storage, window_seconds, max_entries, local_size):
+        self.storage = storage
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.local_size = local_size
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+        self._claims = itertools.count(1)
+
+    @staticmethod
+    def event_id(event):
+        return getattr(event, 'webhook_event_id', None)
+
+    @staticmethod
+    def is_redelivery(event):
+        return bool(getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False))
 
-        # 2. 篩選出首次通關的紀錄
-        #    我們假設 B欄(索引1)是名稱，D欄(索引3)是時間，G欄(索引6)是首次通關標記
-        first_completion_records = []
-        for row in all_values:
-            # 檢查 G 欄 (索引 6) 是否為 '是'
-            # 並且檢查 D 欄 (索引 3) 是否有時間值
-            if len(row) > 6 and row[6].strip() == '是' and len(row) > 3 and row[3]:
+    def claim(self, event):
+        """第一次看到這個事件時回傳 True；重複的事件回傳 False。沒有 webhookEventId 的事件一律放行。"""
+        event_id = self.event_id(event)
+        if not event_id:
+            return True
+        redelivery = self.is_redelivery(event)
+        if redelivery:
+            WEBHOOK_REDELIVERIES.inc()
+        with self._lock:
+            duplicate = event_id in self._recent
+            if not duplicate:
+                self._recent[event_id] = True
+                while len(self._recent) > self.local_size:
+                    self._recent.popitem(last=False)
+        if not duplicate:
+            now = time.time()
+            try:
+                duplicate = not self.storage.claim_event(event_id, now)
+            except Exception:
+                # 資料庫認領失敗 (例如 database is locked) 時 /callback 會回 500，
+                # 本機 LRU 不能留下紀錄，否則 LINE 重送時會被當成重複事件丟掉
+                with self._lock:
+                    self._recent.pop(event_id, None)
+                raise
+            if next(self._claims) % self.PRUNE_EVERY == 0:
                 try:
-                    name = row[1]
-                    time_spent = float(row[3])
-                    first_completion_records.append({'name': name, 'time': time_spent})
-                except (ValueError, IndexError):
-                    # 如果時間格式不對或該行資料不完整，就跳過這筆紀錄
-                    continue
-        
-        if not first_completion_records:
-            return "目前還沒有玩家首次完成挑戰！"
-            
-        # 3. 根據時間進行排序 (時間越少越前面)
-        sorted_records = sorted(first_completion_records, key=lambda x: x['time'])
+                    self.storage.prune_events(now - self.window_seconds, self.max_entries)
+                except Exception as e:
+                    # 事件已認領成功，清理失敗留到下一輪
+                    print(f"清理 webhook 事件紀錄失敗: {e}")
+        if duplicate:
+            WEBHOOK_DUPLICATES.inc(str(redelivery).lower())
+            print(f"略過重複的 webhook 事件 {event_id} (isRedelivery={redelivery})")
+        return not duplicate
 
-        # 4. 取出前 5 名並格式化輸出文字
-        top_5_records = sorted_records[:5]
+    def release(self, event):
+        """事件沒能進入佇列 (例如回 503 請 LINE 重送) 時取消認領，重送時才會處理。"""
+        event_id = self.event_id(event)
+        if not event_id:
+            return
+        with self._lock:
+            self._recent.pop(event_id, None)
+        self.storage.release_event(event_id)
 
-        leaderboard_text = "🏆 積分計時排行榜 🏆\n\n"
-        rank_emojis = ["🥇", "🥈", "🥉", "⒋", "⒌"]
+webhook_dedup = WebhookDeduplicator(storage, WEBHOOK_DEDUP_WINDOW_SECONDS, WEBHOOK_DEDUP_MAX_ENTRIES,
+                                    WEBHOOK_DEDUP_LOCAL_SIZE)
 
-        for i, record in enumerate(top_5_records):
-            rank = rank_emojis[i]
-            name = record.get('name', '匿名玩家')
-            time_spent = record.get('time', 'N/A')
-            leaderboard_text += f"{rank} {name} - {time_spent} 秒\n"
+# ====== 事件分派 (背景工作執行緒) ======
+# 工作執行緒數量 (同時處理的玩家數上限)，0 代表維持舊行為：在 /callback 內同步處理
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+# 每條佇列最多排隊的事件數，滿了就是背壓
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get('WEBHOOK_ENQUEUE_TIMEOUT', 2))
 
-        return leaderboard_text.strip()
+_handler_label = threading.local()
 
-    except gspread.exceptions.APIError as e:
-        print(f"Google Sheets API 錯誤: {e}")
-        return "讀取排行榜時發生 API 錯誤，請檢查權限或稍後再試。"
-    except Exception as e:
-        print(f"產生排行榜時發生未預期的錯誤: {e}")
-        return "讀取排行榜時發生了一點小問題，請稍後再試！"
+def set_handler_label(label):
+    """handler 內標記這次事件屬於哪個指令或遊戲階段，供延遲指標分類 (避免把玩家輸入的文字當標籤)。"""
+    _handler_label.value = label
+
+# 事件 handler 註冊表：(事件類別, 訊息類別或 None) -> 函式。
+# 自己維護而不讀 WebhookHandler 的私有屬性，升級 line-bot-sdk 時不會默默把事件分派到 None
+_event_handlers = {}
+
+def on_event(event_type, message=None):
+    """登記事件 handler，用法與 WebhookHandler.add 相同。"""
+    def decorator(func):
+        _event_handlers[(event_type, message)] = func
+        return func
+    return decorator
+
+def find_handler(event):
+    """訊息事件先找 (事件, 訊息類別)，再找只登記事件類別的 handler；都沒有時回傳 None。"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = _event_handlers.get((type(event), type(event.message)))
+    return func or _event_handlers.get((type(event), None))
+
+def dispatch_event(event):
+    """依 on_event 登記的 handler 分派單一事件。"""
+    set_handler_label(event.message.type if isinstance(event, MessageEvent) else event.type)
+    started = time.perf_counter()
+    try:
+        _invoke_handler(event)
+    finally:
+        elapsed = time.perf_counter() - started
+        label = _handler_label.value
+        HANDLER_LATENCY.observe(elapsed, label)
+        if SLOW_REQUEST_THRESHOLD_MS and elapsed * 1000 > SLOW_REQUEST_THRESHOLD_MS:
+            SLOW_REQUESTS.inc(label)
+            print(f"慢請求：{label} 花了 {elapsed * 1000:.0f} 毫秒 (user {getattr(event.source, 'user_id', None)})")
+
+def _invoke_handler(event):
+    func = find_handler(event)
+    if func is not None:
+        func(event)
+
+class EventDispatcher:
+    """
+    /callback 驗證簽章後只把事件放進佇列就回 200，由固定數量的工作執行緒處理。
+    同一個 user_id 的事件一定進同一條佇列，確保 user_states 的進度依序推進；
+    不同玩家分散在不同佇列上平行處理。
+    """
+    def __init__(self, workers, queue_size, enqueue_timeout):
+        self.enqueue_timeout = enqueue_timeout
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {'enqueued': 0, 'processed': 0, 'failed': 0, 'rejected': 0}
+        self._max_wait = 0.0
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f'webhook-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, event):
+        """放入該玩家專屬的佇列；佇列滿且等待逾時則回傳 False。"""
+        if not self._queues:
+            dispatch_event(event)
+            return True
+        user_id = getattr(event.source, 'user_id', None) or ''
+        q = self._queues[hash(user_id) % len(self._queues)]
+        try:
+            q.put((event, time.monotonic()), timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('enqueued')
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            event, enqueued_at = item
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._max_wait = max(self._max_wait, waited)
+            try:
+                dispatch_event(event)
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                print(f"處理事件時發生錯誤: {e}")
+            finally:
+                q.task_done()
+
+    def stats(self):
+        depths = [q.qsize() for q in self._queues]
+        with self._lock:
+            return dict(self._counters, workers=len(self._queues), queue_depth=sum(depths),
+                        max_queue_depth=max(depths, default=0), max_wait_seconds=round(self._max_wait, 3))
 
-# ====== Webhook 入口 (不變) ======
+    def stop(self):
+        """關機時讓每條佇列把已收下的事件處理完再結束。"""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+event_dispatcher = EventDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_ENQUEUE_TIMEOUT)
+if BACKGROUND_ENABLED:
+    event_dispatcher.start()
+    atexit.register(event_dispatcher.stop)
+
+metrics.gauge('linebot_active_sessions', "user_states 中進行中的遊戲數", lambda: len(user_states))
+metrics.gauge('linebot_dispatch_queue_depth', "等待處理的 webhook 事件數", lambda: event_dispatcher.stats()['queue_depth'])
+metrics.gauge('linebot_sheet_sync_backlog', "尚未同步到工作表的紀錄數", lambda: sheet_syncer.qsize())
+metrics.gauge('linebot_sheet_hot_rows', "熱表 (sheet1) 上的紀錄數，超過上限會輪替到封存表", lambda: storage.hot_row_stats()[0])
+metrics.gauge('linebot_sheets_read_tokens', "Sheets 讀取配額剩餘 token", lambda: sheets_gateway.buckets['read'].available())
+metrics.gauge('linebot_sheets_write_tokens', "Sheets 寫入配額剩餘 token", lambda: sheets_gateway.buckets['write'].available())
+metrics.gauge('linebot_ready', "本機資料庫與排行榜是否已預熱完成 (1/0)", lambda: int(sheets_supervisor.ready))
+metrics.gauge('linebot_degraded', "是否處於降級模式 (Google Sheets 斷線或同步失敗) (1/0)", lambda: int(bool(sheets_supervisor.degraded_reasons())))
+
+# ====== 打卡照片存檔 (背景下載，獨立的工作執行緒) ======
+PHOTO_ARCHIVE_DIR = os.environ.get('PHOTO_ARCHIVE_DIR', 'photos')
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', 2))  # 與 WEBHOOK_WORKERS 分開，下載慢不會拖住遊戲流程
+PHOTO_QUEUE_SIZE = int(os.environ.get('PHOTO_QUEUE_SIZE', 200))
+PHOTO_CHUNK_SIZE = int(os.environ.get('PHOTO_CHUNK_SIZE', 64 * 1024))
+PHOTO_MAX_FILE_BYTES = int(os.environ.get('PHOTO_MAX_FILE_BYTES', 10 * 1024 * 1024))
+PHOTO_MAX_TOTAL_BYTES = int(os.environ.get('PHOTO_MAX_TOTAL_BYTES', 2 * 1024 * 1024 * 1024))
+PHOTO_RETENTION_DAYS = float(os.environ.get('PHOTO_RETENTION_DAYS', 45))
+PHOTO_EVICT_EVERY = int(os.environ.get('PHOTO_EVICT_EVERY', 20))  # 每存幾張檢查一次容量與保存期限
+
+PHOTOS_STORED = metrics.counter('linebot_photos_total', "打卡照片處理結果", ('result',))
+PHOTO_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+
+class PhotoArchive:
+    """
+    把第三關的打卡照片從 LINE 下載到本機：以 PHOTO_CHUNK_SIZE 分段串流寫入暫存檔並同時計算 SHA-256，
+    相同內容只保留一份 (photos/ab/abcdef….jpg)，並在資料庫中連結到玩家的「編號-次數」紀錄。
+    超過保存天數或總容量上限時，由最舊的照片開始刪除。
+    """
+    def __init__(self, storage, line_api, root, workers, queue_size):
+        self.storage = storage
+        self.line_api = line_api
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self._threads = []
+        self._stored = 0
+
+    def submit(self, message_id, user_id, record_key):
+        """排入下載佇列；佇列滿時放棄這張照片，不阻塞 webhook。"""
+        try:
+            self.queue.put_nowait((message_id, user_id, record_key))
+            return True
+        except queue.Full:
+            PHOTOS_STORED.inc('dropped')
+            print(f"照片佇列已滿，略過 {record_key} 的打卡照片")
+            return False
+
+    def _download(self, message_id):
+        """串流下載到暫存檔，回傳 (暫存檔路徑, sha256, 大小, content type)。"""
+        response = self.line_api.open_content(message_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(PHOTO_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > PHOTO_MAX_FILE_BYTES:
+                        raise ValueError(f"照片超過 {PHOTO_MAX_FILE_BYTES} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            _remove_file(tmp_path)
+            raise
+        finally:
+            response.close()
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        return tmp_path, digest.hexdigest(), size, content_type
+
+    def store(self, message_id, user_id, record_key):
+        tmp_path, sha256, size, content_type = self._download(message_id)
+        relative_path = os.path.join(sha256[:2], sha256 + PHOTO_EXTENSIONS.get(content_type, ''))
+        final_path = os.path.join(self.root, relative_path)
+        if os.path.exists(final_path):
+            _remove_file(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+        new_blob = self.storage.add_photo(message_id, record_key, user_id, sha256, relative_path, size, content_type)
+        PHOTOS_STORED.inc('stored' if new_blob else 'deduplicated')
+        self._stored += 1
+        if self._stored % PHOTO_EVICT_EVERY == 0:
+            self.evict()
+        return relative_path
+
+    def evict(self):
+        older_than = time.time() - PHOTO_RETENTION_DAYS * 86400
+        paths = self.storage.evict_photos(older_than, PHOTO_MAX_TOTAL_BYTES)
+        for relative_path in paths:
+            _remove_file(os.path.join(self.root, relative_path))
+        if paths:
+            PHOTOS_STORED.inc('evicted', amount=len(paths))
+            print(f"已清除 {len(paths)} 張過期或超出容量的打卡照片")
+        return len(paths)
+
+    def path_for(self, record_key):
+        """回傳該紀錄最新一張照片的 (絕對路徑, content type)，沒有則回傳 None。"""
+        rows = self.storage.photos_for(record_key)
+        if not rows:
+            return None
+        relative_path, content_type, _ = rows[0]
+        return os.path.join(self.root, relative_path), content_type
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.store(*job)
+            except Exception as e:
+                PHOTOS_STORED.inc('failed')
+                print(f"下載打卡照片失敗 ({job[2]}): {e}")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if self._threads:
+            return
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        try:
+            self.evict()
+        except Exception as e:
+            print(f"清理打卡照片失敗: {e}")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'photo-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+
+    def stats(self):
+        return dict(self.storage.photo_usage(), queue_depth=self.queue.qsize())
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+photo_archive = PhotoArchive(storage, line_api, PHOTO_ARCHIVE_DIR, PHOTO_WORKERS, PHOTO_QUEUE_SIZE)
+if BACKGROUND_ENABLED:
+    photo_archive.start()
+    atexit.register(photo_archive.stop)
+metrics.gauge('linebot_photo_archive_bytes', "打卡照片佔用的磁碟空間", lambda: storage.photo_usage()['bytes'])
+metrics.gauge('linebot_photo_queue_depth', "等待下載的打卡照片數", lambda: photo_archive.queue.qsize())
+
+# ====== 管理介面驗證 ======
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def require_admin(view):
+    """以 Authorization: Bearer <ADMIN_TOKEN> 驗證；未設定 ADMIN_TOKEN 時管理介面整個關閉。"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        supplied = request.headers.get('Authorization', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {ADMIN_TOKEN}'.encode('utf-8')):
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+# ====== Webhook 入口 ======
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+    for event in events:
+        # 重送的事件 (已處理過的 webhookEventId) 在進入佇列前就丟掉
+        if not webhook_dedup.claim(event):
+            continue
+        if not event_dispatcher.submit(event):
+            # 佇列已滿：回 503 讓 LINE 稍後重送，而不是默默丟掉事件
+            webhook_dedup.release(event)
+            print("事件佇列已滿，拒絕本次 webhook")
+            abort(503)
     return 'OK'
-# ====== ★ 圖片判讀 ★ ======
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event):
-    user_id = event.source.user_id
-    reply_token = event.reply_token
 
-    state = user_states.get(user_id)
-    if not state: return
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-    # 檢查是否在第三關等待圖片
-    if state.get('progress') == 3:
-        state['progress'] = 4 # 進度推進到第四關
-        
-        # 準備回覆訊息和下一關題目
-        reply_text = TextSendMessage(text="哇！整個場館你最夏啪！")
-        q4_flex = FlexSendMessage(alt_text="第四關", contents=get_question_4_flex()) # 使用輔助函式取得 JSON
-        
-        # 一次性回覆並發送第四關
-        line_bot_api.reply_message(reply_token, messages=[reply_text, q4_flex])
+@app.route("/status", methods=['GET'])
+def status():
+    return jsonify(dispatcher=event_dispatcher.stats(), completion_queue_depth=sheet_syncer.qsize(),
+                   active_sessions=len(user_states), sheets=sheets_supervisor.stats(),
+                   sheets_quota=sheets_gateway.stats(), photos=photo_archive.stats(),
+                   report_cards=report_cards.stats())
 
-# ====== ★ 修改後的處理文字訊息 (優化費用) ★ ======
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    user_id = event.source.user_id
-    user_message = event.message.text.strip()
-    reply_token = event.reply_token
+@app.route("/photos/<record_key>", methods=['GET'])
+@require_admin
+def checkin_photo(record_key):
+    """工作人員依「編號-次數」查看玩家的打卡照片。"""
+    found = photo_archive.path_for(record_key)
+    if not found or not os.path.exists(found[0]):
+        abort(404)
+    path, content_type = found
+    return send_file(os.path.abspath(path), mimetype=content_type or None, conditional=True, max_age=3600)
 
-    # 最高層級指令
-    if user_message == "開始遊戲":
-        # 如果玩家中途重來，清除舊狀態
-        if user_id in user_states:
-            del user_states[user_id]
-        # 1. 立刻分配並取得玩家資訊
-        player_info = get_player_info(user_id) # 我們等下會修改 get_player_info 的邏輯
-        
-        if not player_info:
-            line_bot_api.reply_message(reply_token, TextSendMessage(text="抱歉，系統忙碌中，無法分配序號，請稍後再試。"))
+def immutable_image(data, etag):
+    """內容永遠不變的 JPEG：長期快取並支援 If-None-Match。"""
+    response = app.response_class(data, mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    response.cache_control.immutable = True
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route("/report-card/<token>/<int:player_id>-<int:play_count>.jpg", methods=['GET'])
+@app.route("/report-card/<token>/<int:player_id>-<int:play_count>-preview.jpg", methods=['GET'], endpoint='report_card_preview')
+def report_card_image(token, player_id, play_count):
+    """成績卡圖片；同一個 (編號, 次數) 內容永遠不變，可讓 LINE 與瀏覽器長期快取。簽章不符一律 404。"""
+    if not report_cards.enabled or not ReportCardRenderer.verify(token, player_id, play_count):
+        abort(404)
+    try:
+        images = report_cards.get(player_id, play_count)
+    except Exception as e:
+        print(f"取得成績卡失敗: {e}")
+        abort(503)
+    if images is None:
+        abort(404)
+    original, preview = images
+    data = preview if request.path.endswith('-preview.jpg') else original
+    return immutable_image(data, hashlib.sha1(data).hexdigest())
+
+@app.route("/assets/<name>", methods=['GET'])
+def asset(name):
+    """自架的圖片資源；檔名含內容雜湊，可永久快取。"""
+    data = assets.get(name)
+    if data is None:
+        abort(404)
+    return immutable_image(data, name)
+
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    """存活檢查：行程能回應就是 200，不碰 Google Sheets。"""
+    return jsonify(status='ok', degraded=bool(sheets_supervisor.degraded_reasons()))
+
+@app.route("/readyz", methods=['GET'])
+def readyz():
+    """就緒檢查：快取預熱完成前回 503，讓負載平衡器暫不導入流量；降級模式仍算就緒。"""
+    stats = sheets_supervisor.stats()
+    return jsonify(stats), 200 if stats['ready'] else 503
+
+# ====== 管理介面：匯出與漏斗報表 ======
+# 匯出欄位：工作表 A–I 欄，再加上兌獎時間
+EXPORT_COLUMNS = ['編號', '名稱', '完成時間', '花費秒數', 'LINE User ID', '是否已兌獎', '首次通關', '玩家編號', '遊玩次數', '兌獎時間']
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def _csv_safe(value):
+    """玩家輸入的名稱若以公式字元開頭，加上 ' 讓 Excel 當成文字，不會執行 (CSV injection)。"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def export_csv(rows):
+    """每批 EXPORT_BATCH_SIZE 列輸出一次；開頭加 BOM 讓 Excel 正確辨識中文。"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    while True:
+        batch = list(itertools.islice(rows, EXPORT_BATCH_SIZE))
+        writer.writerows([_csv_safe(value) for value in row] for row in batch)
+        if buffer.tell():
+            yield buffer.getvalue()
+        if not batch:
             return
+        buffer.seek(0)
+        buffer.truncate()
 
-        # 2. 將預分配的資訊存入狀態
-        user_states[user_id] = {
-            'progress': -1, # 代表等待輸入姓名
-            'player_info': player_info # ★ 將序號資訊先存起來
-        }
-        
-        # 3. 要求使用者輸入姓名
-        line_bot_api.reply_message(reply_token, TextSendMessage(text="歡迎來到問答挑戰！\n請輸入您想在遊戲中使用的名稱："))
-        return
-        
-    if user_message == "排行榜":
-            print("====== 觸發排行榜功能 ======")
-            leaderboard_text = get_leaderboard()
-            print(f"排行榜函式回傳內容: {leaderboard_text}")
-            if not leaderboard_text:
-                leaderboard_text = "抱歉，目前無法取得排行榜資料。"
-            line_bot_api.reply_message(reply_token, TextSendMessage(text=leaderboard_text))
-            print("====== 排行榜訊息已發送 ======")
+def export_ndjson(rows):
+    while True:
+        batch = list(itertools.islice(rows, EXPORT_BATCH_SIZE))
+        if not batch:
             return
-    # ★★★★★★★★★★★★★★★★★★★★★★★★★
-    # ★     這裡是新增的「進入遊戲」邏輯   ★
-    # ★★★★★★★★★★★★★★★★★★★★★★★★★
-    elif user_message == "進入遊戲":
-        state = user_states.get(user_id)
-        # 確保玩家是從「開始遊戲」進來的 (progress 應為 0)
-        if state and state.get('progress') == 0:
-            state['progress'] = -1 # 將進度設為 -1 (等待姓名)
-            line_bot_api.reply_message(reply_token, TextSendMessage(text="歡迎來到問答挑戰！\n請輸入您想在遊戲中使用的名稱："))
-        else:
-            # 如果玩家亂打「進入遊戲」，引導他先「開始遊戲」
-            line_bot_api.reply_message(reply_token, TextSendMessage(text="請先輸入「開始遊戲」喔！"))
-        return
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n' for row in batch)
 
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', export_csv),
+    'ndjson': ('application/x-ndjson; charset=utf-8', export_ndjson),
+}
 
-    elif user_message == "週末限定活動報名":
-        flex_link_message = {"type": "bubble", "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "週末限定活動", "weight": "bold", "size": "xl"}, {"type": "text", "text": "名額有限，請點擊下方按鈕立即報名！", "margin": "md", "wrap": True}, {"type": "separator", "margin": "xxl"}, {"type": "button", "style": "primary",  "color": "#4D96FF", "margin": "xl", "height": "sm", "action": {"type": "uri", "label": "點我前往報名", "uri": "https://docs.google.com/forms/d/e/1FAIpQLSc28lR_7rCNwy7JShQBS9ags6DL0NinKXIUIDJ4dv6YwAIzuA/viewform?usp=dialog"}}]}}
-        line_bot_api.reply_message(reply_token, FlexSendMessage(alt_text="週末限定活動報名連結", contents=flex_link_message))
-        return
+@app.route("/admin/export.<fmt>", methods=['GET'])
+@require_admin
+def admin_export(fmt):
+    """
+    串流匯出通關紀錄：由資料庫游標逐批讀取並邊讀邊送出，不在記憶體中組出整張表，也不讀工作表。
+    ?since=YYYY-MM-DD 只匯出該時間之後完成的紀錄。
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    since = request.args.get('since', '')
+    if since and not re.fullmatch(r'\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?', since):
+        abort(400)
+    mimetype, render = EXPORT_FORMATS[fmt]
+    stamp = datetime.datetime.now(pytz.timezone('Asia/Taipei')).strftime('%Y%m%d-%H%M%S')
+    response = app.response_class(render(storage.iter_completions(since, EXPORT_BATCH_SIZE)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=completions-{stamp}.{fmt}'
+    response.cache_control.no_store = True
+    return response
 
-    elif user_message == "活動介紹":
-        image_url = "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/ation-v3.jpg"
-        line_bot_api.reply_message(reply_token, ImageSendMessage(original_content_url=image_url, preview_image_url=image_url))
-        return
-        
-    elif user_message == "平日常態活動":
-        image_url = "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/week-V1.jpg"
-        line_bot_api.reply_message(reply_token, ImageSendMessage(original_content_url=image_url, preview_image_url=image_url))
-        return
-    
+@app.route("/admin/funnel", methods=['GET'])
+@require_admin
+def admin_funnel():
+    """各關卡的漏斗與停留時間，全部來自預先彙總的資料。"""
+    return jsonify(stages=funnel.snapshot(), totals=storage.completion_totals(), active_sessions=len(user_states))
+
+# ====== ★ 關卡設定 (levels.json，表格驅動的狀態機) ★ ======
+# 題目、正確答案、答錯回覆與關卡轉移都寫在設定檔裡；
+# 啟動時編譯成 (關卡, 輸入) -> 轉移 的字典，每則訊息只需一次查表。
+# 設定檔修改後會自動重新載入，不必重新部署或重啟。
+QUIZ_CONFIG_PATH = os.environ.get('QUIZ_CONFIG_PATH', os.path.join(BASE_DIR, 'levels.json'))
+QUIZ_RELOAD_INTERVAL = float(os.environ.get('QUIZ_RELOAD_INTERVAL', 5))  # 秒；0 代表每則訊息都檢查
+
+IMAGE_INPUT = object()  # 代表「使用者傳了一張圖片」的特殊輸入鍵
+
+Transition = collections.namedtuple('Transition', ['next', 'replies', 'action'])
+
+
+class QuizLevels:
+    """編譯後、唯讀的關卡表。"""
+
+    def __init__(self, transitions, defaults, source_mtime):
+        self.transitions = transitions  # (progress, 輸入) -> Transition
+        self.defaults = defaults        # progress -> Transition (文字輸入沒有對應時)
+        self.source_mtime = source_mtime
+
+    def lookup(self, progress, user_input):
+        transition = self.transitions.get((progress, user_input))
+        if transition is None and user_input is not IMAGE_INPUT:
+            transition = self.defaults.get(progress)
+        return transition
+
+
+# 這些動作會把玩家推進到 next 指定的關卡，設定中一定要有 next
+ACTIONS_REQUIRING_NEXT = frozenset(('register_name', 'record_completion'))
+
+def _expect(value, kind, where):
+    if not isinstance(value, kind):
+        raise ValueError(f"{where} 的格式錯誤：應為 {kind.__name__}，實際是 {type(value).__name__}")
+    return value
+
+def _stage_number(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{where} 不是關卡編號: {value!r}")
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{where} 不是關卡編號: {value!r}") from None
+
+def compile_levels(config, actions, source_mtime=None):
+    """把 levels.json 的內容驗證並編譯成 QuizLevels；設定有誤 (包含格式不對) 時一律丟出 ValueError。"""
+    _expect(config, dict, "levels.json")
+    raw_messages = _expect(config.get('messages', {}), dict, "messages")
+    messages = {key: _dumps(self_hosted(_expect(payload, dict, f"訊息 {key}"))).encode('utf-8')
+                for key, payload in raw_messages.items()}
+    raw_stages = _expect(config.get('stages', {}), dict, "stages")
+    known_stages = {_stage_number(stage_key, "stages 的 key") for stage_key in raw_stages}
+
+    def build(stage, spec):
+        where = f"關卡 {stage}"
+        _expect(spec, dict, where)
+        action = spec.get('action')
+        if action is not None and action not in actions:
+            raise ValueError(f"{where} 使用了未知的動作: {action}")
+        replies = []
+        for key in _expect(spec.get('reply', []), list, f"{where} 的 reply"):
+            if not isinstance(key, str) or key not in messages:
+                raise ValueError(f"{where} 引用了不存在的訊息: {key}")
+            replies.append(messages[key])
+        next_stage = spec.get('next')
+        if next_stage is not None:
+            next_stage = _stage_number(next_stage, f"{where} 的 next")
+            if next_stage not in known_stages:
+                raise ValueError(f"{where} 的 next 指向不存在的關卡: {next_stage}")
+        elif action in ACTIONS_REQUIRING_NEXT:
+            raise ValueError(f"{where} 的動作 {action} 必須指定 next")
+        return Transition(next_stage, tuple(replies), action)
+
+    transitions, defaults = {}, {}
+    for stage_key, stage in raw_stages.items():
+        progress = _stage_number(stage_key, "stages 的 key")
+        _expect(stage, dict, f"關卡 {stage_key}")
+        for user_input, spec in _expect(stage.get('inputs', {}), dict, f"關卡 {stage_key} 的 inputs").items():
+            transitions[(progress, user_input)] = build(stage_key, spec)
+        if 'image' in stage:
+            transitions[(progress, IMAGE_INPUT)] = build(stage_key, stage['image'])
+        if 'default' in stage:
+            defaults[progress] = build(stage_key, stage['default'])
+    return QuizLevels(transitions, defaults, source_mtime)
+
+
+class QuizEngine:
+    """持有目前生效的關卡表，並依檔案修改時間做熱重載。"""
+
+    def __init__(self, path, actions, reload_interval=QUIZ_RELOAD_INTERVAL):
+        self.path = path
+        self.actions = actions
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._bad_mtime = None  # 載入失敗的設定檔版本，修好 (mtime 改變) 之前不再重試
+        self.levels = self._load()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding='utf-8') as f:
+            config = json.load(f)
+        return compile_levels(config, self.actions, mtime)
+
+    def current(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return self.levels
+        mtime = None
+        try:
+            self._next_check = now + self.reload_interval
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self.levels.source_mtime and mtime != self._bad_mtime:
+                self.levels = self._load()  # 整份替換，處理中的訊息仍使用舊表
+                print(f"關卡設定已重新載入: {self.path}")
+        except Exception as e:
+            # 設定檔寫壞 (讀不到、JSON 錯誤、格式不對) 時維持舊的關卡表，避免遊戲中斷
+            self._bad_mtime = mtime
+            print(f"重新載入關卡設定失敗，沿用舊設定: {e}")
+        finally:
+            self._lock.release()
+        return self.levels
+
+    def handle(self, user_id, state, progress, user_input, reply_token):
+        """依 (關卡, 輸入) 查表執行一次轉移；沒有對應的轉移時不回應。"""
+        transition = self.current().lookup(progress, user_input)
+        if transition is None:
+            return False
+        if transition.action:
+            self.actions[transition.action](user_id, state, user_input, reply_token, transition)
+            return True
+        if transition.next is not None:
+            advance(state, transition.next)
+            user_states.save(user_id, state)
+        if transition.replies:
+            line_api.reply(reply_token, *transition.replies)
+        return True
+
+
+# ====== 關卡動作 (需要程式邏輯的轉移) ======
+def action_register_name(user_id, state, user_message, reply_token, transition):
+    player_name = user_message
+    # ★ 玩家資訊已在「開始遊戲」時取得，現在只需要更新狀態即可
+    state['name'] = player_name
+    state['start_time'] = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
+    advance(state, transition.next)
+    user_states.save(user_id, state)
+
+    player_info = state['player_info'] # 從 state 中讀取預分配的資訊
+    reply_text = f"你好，{player_name}！\n你的挑戰編號是 {player_info['id']}-{player_info['play_count']} 號。\n\n遊戲現在開始！"
+    # 合併回覆歡迎詞和第一題 (免費)
+    line_api.reply(reply_token, text_message(reply_text), *transition.replies)
+
+
+def action_record_completion(user_id, state, user_message, reply_token, transition):
+    # 1. 記錄成績
+    record_result = record_completion(user_id)
+
+    # 2. 推進到等待兌換狀態
+    advance(state, transition.next)
+    user_states.save(user_id, state)
+
+    # 3. 準備並傳送最終的 Flex 選單
+    if record_result:
+        messages = [get_final_redemption_menu(record_result)]
+        if report_cards.enabled:
+            # 先送進 process pool 繪製，LINE 來抓圖片時多半已經畫好
+            report_cards.submit(record_result['player_id'], record_result['count'], record_result['name'], record_result['duration'])
+            messages.insert(0, image_message(*ReportCardRenderer.urls(record_result['player_id'], record_result['count'])))
+        line_api.reply(reply_token, *messages, *transition.replies)
+    else:
+        # 如果記錄失敗，回傳錯誤訊息，並直接清除玩家狀態
+        line_api.reply(reply_token, text_message("恭喜通關！但在記錄成績時發生錯誤，請聯繫管理員。"))
+        if user_id in user_states:
+            del user_states[user_id]
+
+
+REDEEM_REPLIES = {'success': "獎項兌換成功！", 'already_redeemed': "您已兌換過獎品囉！", 'not_found': "您尚未完成遊戲挑戰，無法兌換獎品喔！"}
+
+def action_redeem_prize(user_id, state, user_message, reply_token, transition):
+    result = redeem_prize(user_id)
+    reply_text = REDEEM_REPLIES.get(result, "兌換時發生錯誤，請聯繫管理員。")
+    advance(state, None)
+    if user_id in user_states: del user_states[user_id] # 兌換後清除狀態
+    line_api.reply(reply_token, text_message(reply_text))
+
+
+QUIZ_ACTIONS = {
+    'register_name': action_register_name,
+    'record_completion': action_record_completion,
+    'redeem_prize': action_redeem_prize,
+}
+
+quiz = QuizEngine(QUIZ_CONFIG_PATH, QUIZ_ACTIONS)
+
+# ====== ★ 圖片判讀 ★ ======
+@on_event(MessageEvent, message=ImageMessage)
+def handle_image_message(event):
+    user_id = event.source.user_id
     state = user_states.get(user_id)
-    if not state:
-        return
-        
-    progress = state.get('progress', 0)
+    if not state: return
 
-    # ★ 優化點 1: 輸入姓名後，合併回覆歡迎詞和第一題 (免費)
-    if progress == -1:
-        player_name = user_message
-        # ★ 玩家資訊已在「開始遊戲」時取得，現在只需要更新狀態即可
-        state['name'] = player_name
-        state['start_time'] = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
-        state['progress'] = 1 # 推進到第一題
-        
-        player_info = state['player_info'] # 從 state 中讀取預分配的資訊
-        
-        reply_text = f"你好，{player_name}！\n你的挑戰編號是 {player_info['id']}-{player_info['play_count']} 號。\n\n遊戲現在開始！"
-        welcome_message = TextSendMessage(text=reply_text)
-        q1_flex = FlexSendMessage(alt_text="第一題", contents=get_question_1_flex())
-        
-        line_bot_api.reply_message(reply_token, messages=[welcome_message, q1_flex])
-        return
+    progress = state.get('progress')
+    set_handler_label(f"progress:{progress}")
+    # 例如第三關等待圖片：由關卡表決定下一關與回覆
+    if quiz.handle(user_id, state, progress, IMAGE_INPUT, event.reply_token):
+        # 被關卡接受的照片在背景存檔，連結到玩家的「編號-次數」
+        player_info = state['player_info']
+        photo_archive.submit(event.message.id, user_id, f"{player_info['id']}-{player_info['play_count']}")
 
-        state.update({'name': player_name, 'player_info': player_info, 'start_time': datetime.datetime.now(pytz.timezone('Asia/Taipei')), 'progress': 1})
-        
-        # 準備兩則訊息
-        reply_text = f"你好，{player_name}！\n你的挑戰編號是 {player_info['id']}-{player_info['play_count']} 號。\n\n遊戲現在開始！"
-        welcome_message = TextSendMessage(text=reply_text)
-        # 使用輔助函式取得第一題的 Flex JSON
-        q1_flex = FlexSendMessage(alt_text="第一題", contents=get_question_1_flex())
-        
-        # 合併在一個 reply_message 中發送
-        line_bot_api.reply_message(reply_token, messages=[welcome_message, q1_flex])
+# ====== ★ 全域指令 (任何關卡都能使用) ★ ======
+def command_start_game(user_id, reply_token):
+    # 如果玩家中途重來，清除舊狀態
+    if user_id in user_states:
+        del user_states[user_id]
+    # 1. 立刻分配並取得玩家資訊
+    player_info = get_player_info(user_id)
+
+    if not player_info:
+        line_api.reply(reply_token, text_message("抱歉，系統忙碌中，無法分配序號，請稍後再試。"))
         return
 
-    # ★ 優化點 2: 答題過程全部改用 reply_token (免費)
-    if progress == 1:
-        if user_message == "B":
-            state['progress'] = 2
-            send_question_2(reply_token)
-        else:
-            image_url = "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q1-A.jpg"
-            image_message = ImageSendMessage(original_content_url=image_url, preview_image_url=image_url)
-            text_message = TextSendMessage(text="再仔細看看!!!")
-            line_bot_api.reply_message(reply_token, messages=[image_message, text_message])
-
-    elif progress == 2:
-        if user_message == "C":
-            state['progress'] = 3
-            send_question_3(reply_token)
-        else:
-            image_url = "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q2-A.jpg"
-            image_message = ImageSendMessage(original_content_url=image_url, preview_image_url=image_url)
-            text_message = TextSendMessage(text="答錯了！抵達萬花筒區域就可以找到正確解答!")
-            line_bot_api.reply_message(reply_token, messages=[image_message, text_message])
+    # 2. 將預分配的資訊存入狀態
+    state = Session(player_info=player_info) # ★ 將序號資訊先存起來
+    advance(state, -1) # 代表等待輸入姓名
+    user_states.save(user_id, state)
 
-    elif progress == 3:
-        pass
+    # 3. 要求使用者輸入姓名
+    line_api.reply(reply_token, text_message("歡迎來到問答挑戰！\n請輸入您想在遊戲中使用的名稱："))
 
-    elif progress == 4:
-        if user_message == "我已拍照打卡完畢":
-            
-            # 1. 記錄成績
-            record_result = record_completion(user_id)
-            
-            # 2. 將進度設為 5 (等待兌換狀態)
-            state['progress'] = 5
-            
-            # 3. 準備並傳送最終的 Flex 選單
-            if record_result:
-                final_flex = get_final_redemption_menu(record_result)
-                line_bot_api.reply_message(reply_token, FlexSendMessage(alt_text="恭喜通關！", contents=final_flex))
-            else:
-                # 如果記錄失敗，回傳錯誤訊息
-                final_message = "恭喜通關！但在記錄成績時發生錯誤，請聯繫管理員。"
-                line_bot_api.reply_message(reply_token, TextSendMessage(text=final_message))
-                # 記錄失敗時，直接清除玩家狀態
-                if user_id in user_states:
-                    del user_states[user_id]
-        else:
-            # 如果使用者在第四關亂打字，不回應
-            pass
-            
-               # 點擊通關畫面的 "兌換獎項" 按鈕
-    elif progress == 5 and user_message == "兌換獎項":
-        state['progress'] = -2
-        line_bot_api.reply_message(reply_token, TextSendMessage(text="請將手機交給工作人員，並由工作人員輸入兌換碼："))
+def command_leaderboard(user_id, reply_token):
+    print("====== 觸發排行榜功能 ======")
+    leaderboard_text = get_leaderboard()
+    print(f"排行榜函式回傳內容: {leaderboard_text}")
+    if not leaderboard_text:
+        leaderboard_text = "抱歉，目前無法取得排行榜資料。"
+    line_api.reply(reply_token, text_message(leaderboard_text))
+    print("====== 排行榜訊息已發送 ======")
+
+def command_enter_game(user_id, reply_token):
+    state = user_states.get(user_id)
+    # 確保玩家是從「開始遊戲」進來的 (progress 應為 0)
+    if state and state.get('progress') == 0:
+        advance(state, -1) # 將進度設為 -1 (等待姓名)
+        user_states.save(user_id, state)
+        line_api.reply(reply_token, text_message("歡迎來到問答挑戰！\n請輸入您想在遊戲中使用的名稱："))
+    else:
+        # 如果玩家亂打「進入遊戲」，引導他先「開始遊戲」
+        line_api.reply(reply_token, text_message("請先輸入「開始遊戲」喔！"))
+
+def fixed_reply(*messages):
+    """產生只回覆固定訊息的全域指令。"""
+    def command(user_id, reply_token):
+        line_api.reply(reply_token, *messages)
+    return command
+
+# ====== ★ 處理文字訊息 ★ ======
+@on_event(MessageEvent, message=TextMessage)
+def handle_message(event):
+    user_id = event.source.user_id
+    user_message = event.message.text.strip()
+    reply_token = event.reply_token
+
+    # 最高層級指令：一次字典查詢
+    command = GLOBAL_COMMANDS.get(user_message)
+    if command:
+        set_handler_label(user_message)
+        command(user_id, reply_token)
         return
-    
-    # 輸入兌換碼
-    if progress == -2:
-        if user_message == "PASS":
-            result = redeem_prize(user_id)
-            reply_text = {'success': "獎項兌換成功！", 'already_redeemed': "您已兌換過獎品囉！", 'not_found': "您尚未完成遊戲挑戰，無法兌換獎品喔！"}.get(result, "兌換時發生錯誤，請聯繫管理員。")
-            if user_id in user_states: del user_states[user_id] # 兌換後清除狀態
-            line_bot_api.reply_message(reply_token, TextSendMessage(text=reply_text))
-        else:
-            line_bot_api.reply_message(reply_token, TextSendMessage(text="兌換碼錯誤，請重新輸入。"))
+
+    state = user_states.get(user_id)
+    if not state:
         return
 
-# ====== ★ 題目與選單函式 (修改為使用 reply_token) ★ ======
+    progress = state.get('progress', 0)
+    set_handler_label(f"progress:{progress}")
+    quiz.handle(user_id, state, progress, user_message, reply_token)
+
+# ====== ★ 題目與選單函式 (訊息在啟動時就序列化好) ★ ======
+START_MENU_MESSAGE = flex_message('開始選單', {"type": "bubble", "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "歡迎！", "weight": "bold", "size": "xl"}, {"type": "text", "text": "請選擇您的下一步動作：", "margin": "md"}, {"type": "button", "action": {"type": "message", "label": "進入遊戲", "text": "進入遊戲"}, "style": "primary", "color": "#5A94C7", "margin": "xxl"}, {"type": "button", "action": {"type": "message", "label": "兌換獎項", "text": "兌換獎項"}, "style": "secondary", "margin": "md"}]}})
+
 def send_start_menu(reply_token):
-    flex_message = FlexSendMessage(alt_text='開始選單', contents={"type": "bubble", "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "歡迎！", "weight": "bold", "size": "xl"}, {"type": "text", "text": "請選擇您的下一步動作：", "margin": "md"}, {"type": "button", "action": {"type": "message", "label": "進入遊戲", "text": "進入遊戲"}, "style": "primary", "color": "#5A94C7", "margin": "xxl"}, {"type": "button", "action": {"type": "message", "label": "兌換獎項", "text": "兌換獎項"}, "style": "secondary", "margin": "md"}]}})
-    line_bot_api.reply_message(reply_token, flex_message)
+    line_api.reply(reply_token, START_MENU_MESSAGE)
 
-def send_game_entry_menu(reply_token):
-    """
-    發送包含「進入遊戲」和「排行榜」按鈕的 Flex Message。
-    """
-    flex_message = FlexSendMessage(
-        alt_text='歡迎來到問答挑戰',
-        contents={
-            "type": "bubble",
-            "body": {
+GAME_ENTRY_MENU_MESSAGE = flex_message('歡迎來到問答挑戰', {
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "歡迎來到問答挑戰！",
+                "weight": "bold",
+                "size": "xl"
+            },
+            {
+                "type": "text",
+                "text": "準備好就進入遊戲，或先看看高手們的紀錄！",
+                "margin": "md",
+                "wrap": True
+            },
+            {
                 "type": "box",
                 "layout": "vertical",
+                "margin": "xxl",
+                "spacing": "sm",
                 "contents": [
                     {
-                        "type": "text",
-                        "text": "歡迎來到問答挑戰！",
-                        "weight": "bold",
-                        "size": "xl"
-                    },
-                    {
-                        "type": "text",
-                        "text": "準備好就進入遊戲，或先看看高手們的紀錄！",
-                        "margin": "md",
-                        "wrap": True
+                        "type": "button",
+                        "action": {
+                            "type": "message",
+                            "label": "進入遊戲",
+                            "text": "進入遊戲"
+                        },
+                        "style": "primary",
+                        "color": "#4D96FF",
+                        "height": "sm"
                     },
                     {
-                        "type": "box",
-                        "layout": "vertical",
-                        "margin": "xxl",
-                        "spacing": "sm",
-                        "contents": [
-                            {
-                                "type": "button",
-                                "action": {
-                                    "type": "message",
-                                    "label": "進入遊戲",
-                                    "text": "進入遊戲"
-                                },
-                                "style": "primary",
-                                "color": "#4D96FF",
-                                "height": "sm"
-                            },
-                            {
-                                "type": "button",
-                                "action": {
-                                    "type": "message",
-                                    "label": "排行榜",
-                                    "text": "排行榜"
-                                },
-                                "style": "secondary",
-                                "height": "sm"
-                            }
-                        ]
+                        "type": "button",
+                        "action": {
+                            "type": "message",
+                            "label": "排行榜",
+                            "text": "排行榜"
+                        },
+                        "style": "secondary",
+                        "height": "sm"
                     }
                 ]
             }
-        }
-    )
-    line_bot_api.reply_message(reply_token, flex_message)
-
-# ★ 新增輔助函式，用於取得第一題的 Flex JSON
-# ★ 修改點 ★
-def get_question_1_flex():
-    # 注意：請將圖片 URL 換成您自己的
-    return {"type": "bubble", "hero": {"type": "image", "url": "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q1-V1.jpg", "size": "full", "aspectRatio": "1.51:1", "aspectMode": "fit"}, "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "關卡一：找找我在哪在第10-15頁之間!～", "weight": "bold", "size": "lg"}, {"type": "text", "text": "找到這本神秘的大書，從左邊翻開數第8頁，數數看，圖片中有幾隻雞呢?", "margin": "md", "wrap": True}, {"type": "separator", "margin": "lg"}, {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [{"type": "button", "style": "primary",  "color": "#4D96FF","action": {"type": "message", "label": "A：５隻雞", "text": "A"}}, {"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "B：７隻雞", "text": "B"}}, {"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "C：９隻雞", "text": "C"}}, {"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "D：沒有雞", "text": "D"}}]}]}}
-
-def send_question_2(reply_token):
-    # 注意：請將圖片 URL 換成您自己的
-    flex_message = {"type": "bubble", "hero": {"type": "image", "url": "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q2-V2.jpg", "size": "full", "aspectRatio": "1.51:1", "aspectMode": "fit"}, "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "關卡二：尋找寶藏 ─ 拼圖遊戲", "weight": "bold", "size": "lg"}, {"type": "text", "text": "手腦並用完成拼圖挑戰，拼出藏寶路線圖。\n請問王博士得到的寶藏是什麼呢？", "margin": "md", "wrap": True}, {"type": "separator", "margin": "lg"}, {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [{"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "糖果", "text": "A"}}, {"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "水槍", "text": "B"}}, {"type": "button", "style": "primary",  "color": "#4D96FF","action": {"type": "message", "label": "草莓", "text": "C"}}, {"type": "button", "style": "primary", "color": "#4D96FF", "action": {"type": "message", "label": "小兔子", "text": "D"}}]}]}}
-    line_bot_api.reply_message(reply_token, FlexSendMessage(alt_text="第二關", contents=flex_message))
-
-def send_question_3(reply_token):
-    # 注意：請將圖片 URL 換成您自己的
-    reply_text = "關卡三：全場我最亮 ─ 與飛天小女警拍美照\n\n找到場館內的飛天小女警打卡區，戴上夏啪拍照小物再拍張照，今夏的美好回憶全在台塑生醫健康悠活館！\n\n拍完照記得利用訊息傳回來給我們唷～"
-    q3_image = ImageSendMessage(
-        original_content_url="https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q3.jpg",
-        preview_image_url="https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q3.jpg"
-    )
-    line_bot_api.reply_message(reply_token, messages=[q3_image, TextSendMessage(text=reply_text)])
-
-def get_question_4_flex():
-    # 注意：請將圖片 URL 換成您自己的
-    return {"type": "bubble", "hero": {"type": "image", "url": "https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/Q4-V2.png", "size": "full", "aspectRatio": "1.51:1", "aspectMode": "fit"}, "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "關卡四：台塑生醫 x 飛天小女警", "weight": "bold", "size": "lg"}, {"type": "text", "text": "在一樓商品銷售區找到聯名商品，拍張照並上傳到社群，並上傳到FB或IG(限時動態亦可)，出示給販售區工作人員，即可得到飛天小女警的扇子！", "margin": "md", "wrap": True}]}, "footer": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "我已拍照打卡完畢，請工作人員審核並點選", "wrap": True, "align": "center", "size": "sm"}, {"type": "button", "style": "primary",  "color": "#4D96FF", "margin": "md", "action": {"type": "message", "label": "確認審核", "text": "我已拍照打卡完畢"}}]}}
+        ]
+    }
+})
+
+def send_game_entry_menu(reply_token):
+    """
+    發送包含「進入遊戲」和「排行榜」按鈕的 Flex Message。
+    """
+    line_api.reply(reply_token, GAME_ENTRY_MENU_MESSAGE)
+
+FINAL_REDEMPTION_TEMPLATE = FlexTemplate("恭喜通關！", {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [{"type": "text", "text": "{{title}}", "weight": "bold", "size": "xl", "wrap": True, "align": "center"}, {"type": "text", "text": "{{body_text}}", "align": "center", "wrap": True}, {"type": "separator", "margin": "lg"}, {"type": "text", "text": "您的兌換碼為【PASS】。", "margin": "lg", "weight": "bold", "align": "center"}, {"type": "text", "text": "（請將此畫面出示給關主，由關主為您操作兌換，請勿自行輸入）", "wrap": True, "size": "xs", "align": "center", "color": "#888888"}, {"type": "button", "style": "primary", "color": "#4D96FF", "margin": "xl", "action": {"type": "message", "label": "兌換獎項", "text": "兌換獎項"}}]}})
 
 def get_final_redemption_menu(record_result):
     title = "🎉 恭喜你完成所有挑戰！🎊" if record_result['is_first'] else "🎉 挑戰成功！🎉"
     body_text = "您的成績已成功記錄！" if record_result['is_first'] else f"這是您的第 {record_result['count']} 次通關紀錄！"
     
-    return {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [{"type": "text", "text": title, "weight": "bold", "size": "xl", "wrap": True, "align": "center"}, {"type": "text", "text": body_text, "align": "center", "wrap": True}, {"type": "separator", "margin": "lg"}, {"type": "text", "text": "您的兌換碼為【PASS】。", "margin": "lg", "weight": "bold", "align": "center"}, {"type": "text", "text": "（請將此畫面出示給關主，由關主為您操作兌換，請勿自行輸入）", "wrap": True, "size": "xs", "align": "center", "color": "#888888"}, {"type": "button", "style": "primary", "color": "#4D96FF", "margin": "xl", "action": {"type": "message", "label": "兌換獎項", "text": "兌換獎項"}}]}}
+    return FINAL_REDEMPTION_TEMPLATE.render(title=title, body_text=body_text)
+
+# ====== 其他固定回覆 ======
+WEEKEND_SIGNUP_MESSAGE = flex_message("週末限定活動報名連結", {"type": "bubble", "body": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "週末限定活動", "weight": "bold", "size": "xl"}, {"type": "text", "text": "名額有限，請點擊下方按鈕立即報名！", "margin": "md", "wrap": True}, {"type": "separator", "margin": "xxl"}, {"type": "button", "style": "primary",  "color": "#4D96FF", "margin": "xl", "height": "sm", "action": {"type": "uri", "label": "點我前往報名", "uri": "https://docs.google.com/forms/d/e/1FAIpQLSc28lR_7rCNwy7JShQBS9ags6DL0NinKXIUIDJ4dv6YwAIzuA/viewform?usp=dialog"}}]}})
+INTRO_IMAGE_MESSAGE = image_message("https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/ation-v3.jpg")
+WEEKDAY_IMAGE_MESSAGE = image_message("https://raw.githubusercontent.com/chengzi08/tsse-linebot/main/week-V1.jpg")
+
+GLOBAL_COMMANDS = {
+    "開始遊戲": command_start_game,
+    "排行榜": command_leaderboard,
+    "進入遊戲": command_enter_game,
+    "週末限定活動報名": fixed_reply(WEEKEND_SIGNUP_MESSAGE),
+    "活動介紹": fixed_reply(INTRO_IMAGE_MESSAGE),
+    "平日常態活動": fixed_reply(WEEKDAY_IMAGE_MESSAGE),
+}
 
 # ====== 啟動 ======
 if __name__ == "__main__":
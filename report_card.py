@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+個人成績卡繪製 (在 main.py 的 process pool 中執行)。
+
+這個模組刻意不 import main：子行程只需要 PIL，
+不會重新建立 Flask app、Google Sheets 連線或背景執行緒。
+"""
+import io
+
+from PIL import Image, ImageDraw, ImageFont
+
+# 模板上的文字位置 (以 3000x3000 的 report_card_template.jpg 座標表示)
+TEMPLATE_SIZE = 3000
+NAME_POSITION = (945, 320)        # 表格上方，置中
+NUMBER_POSITION = (788, 494)      # 左邊格子：挑戰編號
+DURATION_POSITION = (1102, 494)   # 右邊格子：花費時間
+NAME_FONT_SIZE = 110
+CELL_FONT_SIZE = 80
+TEXT_COLOR = (51, 51, 51)
+
+# 每個子行程只解碼一次的模板與字型
+_base = None
+_preview_size = None
+_fonts = {}
+
+
+def init_worker(template_path, font_path, size, preview_size):
+    """process pool 的 initializer：解碼模板、縮放到輸出尺寸並載入字型 (必須含中文字，內建字型會畫成方塊)。"""
+    global _base, _preview_size
+    with Image.open(template_path) as template:
+        _base = template.convert('RGB').resize((size, size), Image.LANCZOS)
+    _preview_size = preview_size
+    scale = size / TEMPLATE_SIZE
+    _fonts['name'] = ImageFont.truetype(font_path, max(1, int(NAME_FONT_SIZE * scale)))
+    _fonts['cell'] = ImageFont.truetype(font_path, max(1, int(CELL_FONT_SIZE * scale)))
+
+
+def _scaled(position):
+    scale = _base.width / TEMPLATE_SIZE
+    return (position[0] * scale, position[1] * scale)
+
+
+def _encode(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def render(name, record_key, duration):
+    """在預先縮放好的模板上寫入姓名、挑戰編號與時間，回傳 (原圖 JPEG, 預覽圖 JPEG)。"""
+    image = _base.copy()
+    draw = ImageDraw.Draw(image)
+    draw.text(_scaled(NAME_POSITION), str(name), font=_fonts['name'], fill=TEXT_COLOR, anchor='mm')
+    draw.text(_scaled(NUMBER_POSITION), f"No.{record_key}", font=_fonts['cell'], fill=TEXT_COLOR, anchor='mm')
+    draw.text(_scaled(DURATION_POSITION), f"{float(duration):.1f}s", font=_fonts['cell'], fill=TEXT_COLOR, anchor='mm')
+    original = _encode(image, 85)
+    image.thumbnail((_preview_size, _preview_size))
+    return original, _encode(image, 75)
@@ -0,0 +1,120 @@
+"""
+測試共用的設定：Google Sheet 換成程序內的假工作表，本機資料庫每個測試各用一個新檔案。
+
+用法：
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+import gspread
+import pytest
+
+_tmpdir = tempfile.mkdtemp(prefix='linebot-test-')
+os.environ.update({
+    'LINE_CHANNEL_ACCESS_TOKEN': 'test-token',
+    'LINE_CHANNEL_SECRET': 'test-secret',
+    'GOOGLE_SHEET_NAME': 'test',
+    'STORAGE_DB_PATH': os.path.join(_tmpdir, 'linebot.sqlite3'),
+    'SESSION_DB_PATH': os.path.join(_tmpdir, 'sessions.sqlite3'),
+    'PHOTO_ARCHIVE_DIR': os.path.join(_tmpdir, 'photos'),
+    'SHEETS_WRITES_PER_MINUTE': '6000',
+    'SHEETS_READS_PER_MINUTE': '6000',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+HEADER = ["編號", "名稱", "完成時間", "花費秒數", "LINE User ID", "是否已兌獎", "首次通關", "玩家編號", "遊玩次數"]
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, rows=None):
+        self.spreadsheet = spreadsheet
+        self.rows = [list(row) for row in rows or []]
+        self.fail_delete = 0
+        self.fail_after_delete = 0
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+    def get_values(self, range_name):
+        first, last = (int(part) for part in range_name.split(':'))
+        return [list(row) for row in self.rows[first - 1:last]]
+
+    def row_values(self, row):
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def append_rows(self, values, **kwargs):
+        start = len(self.rows) + 1
+        self.rows.extend([[str(v) for v in row] for row in values])
+        return {'updates': {'updatedRange': f"Sheet1!A{start}:I{len(self.rows)}"}}
+
+    def batch_update(self, data, **kwargs):
+        for item in data:
+            self.rows[int(item['range'][1:]) - 1][5] = item['values'][0][0]
+
+    def update(self, values, range_name=None, **kwargs):
+        for index, row in enumerate(values):
+            if index < len(self.rows):
+                self.rows[index] = [str(v) for v in row]
+            else:
+                self.rows.append([str(v) for v in row])
+
+    def resize(self, rows=None, cols=None):
+        self.spreadsheet.resizes.append((self, rows))
+
+    def delete_rows(self, start_index, end_index=None):
+        if self.fail_delete:
+            self.fail_delete -= 1
+            raise RuntimeError("delete_rows failed")
+        del self.rows[start_index - 1:end_index or start_index]
+        if self.fail_after_delete:
+            # 刪除已經生效，但回應逾時
+            self.fail_after_delete -= 1
+            raise RuntimeError("delete_rows timed out")
+
+
+class FakeSpreadsheet:
+    def __init__(self, rows):
+        self.header = HEADER
+        self.sheet1 = FakeWorksheet(self, [HEADER] + rows)
+        self.worksheets = {}
+        self.resizes = []
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.worksheets[title] = FakeWorksheet(self)
+        return self.worksheets[title]
+
+    def archives(self):
+        return [ws for title, ws in self.worksheets.items() if title.startswith('封存')]
+
+
+@pytest.fixture
+def spreadsheet(monkeypatch, tmp_path):
+    storage = main.SqliteBackend(str(tmp_path / 'linebot.sqlite3'))
+    monkeypatch.setattr(main, 'storage', storage)
+    monkeypatch.setattr(main.sheet_rotator, 'storage', storage)
+    monkeypatch.setattr(main.sheet_syncer, 'storage', storage)
+    book = FakeSpreadsheet([
+        ['1-1', 'old', '2025-01-01 10:00:00', '50', 'U_old', '否', '是', '1', '1'],
+    ])
+    main.sheets_supervisor.attach(book.sheet1)
+    assert main.ensure_storage()
+    return book
+
+
+@pytest.fixture
+def complete():
+    """在本機資料庫寫入一筆通關紀錄 (尚未同步到工作表)。"""
+    def complete(storage, user_id, name, duration):
+        info = storage.next_player_info(user_id)
+        storage.add_completion([f"{info['id']}-{info['play_count']}", name, '2025-01-02 10:00:00', duration, user_id,
+                                '否', '是' if info['is_new'] else '否', info['id'], info['play_count']])
+    return complete
@@ -0,0 +1,34 @@
+"""webhook 事件分派：由 SDK 解析出的事件要能找到對應的 handler。"""
+import base64
+import hashlib
+import hmac
+import json
+
+import main
+
+
+def parse(*events):
+    body = json.dumps({'destination': 'U0', 'events': list(events)})
+    signature = base64.b64encode(hmac.new(main.LINE_CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'),
+                                          hashlib.sha256).digest()).decode('utf-8')
+    return main.parser.parse(body, signature)
+
+
+def message_event(message):
+    return {'type': 'message', 'mode': 'active', 'timestamp': 0, 'replyToken': 'r', 'webhookEventId': 'E',
+            'deliveryContext': {'isRedelivery': False}, 'source': {'type': 'user', 'userId': 'U1'}, 'message': message}
+
+
+def test_message_events_resolve_to_their_handlers():
+    text, image = parse(message_event({'id': '1', 'type': 'text', 'text': '排行榜'}),
+                        message_event({'id': '2', 'type': 'image', 'contentProvider': {'type': 'line'}}))
+    assert main.find_handler(text) is main.handle_message
+    assert main.find_handler(image) is main.handle_image_message
+
+
+def test_unhandled_events_resolve_to_none():
+    follow, sticker = parse({'type': 'follow', 'mode': 'active', 'timestamp': 0, 'replyToken': 'r',
+                             'source': {'type': 'user', 'userId': 'U1'}},
+                            message_event({'id': '3', 'type': 'sticker', 'packageId': '1', 'stickerId': '1'}))
+    assert main.find_handler(follow) is None
+    assert main.find_handler(sticker) is None
@@ -0,0 +1,14 @@
+"""LINE API 連線的重試策略。"""
+import main
+
+
+def test_reply_is_only_retried_before_the_request_is_sent():
+    retry = main.line_api.session.get_adapter(main.LineApiClient.REPLY_URL).max_retries
+    assert retry.connect and retry.read == 0 and retry.status == 0 and retry.other == 0
+    assert not retry.is_retry('POST', 500)
+
+
+def test_content_download_retries_server_errors():
+    url = main.LineApiClient.CONTENT_URL.format(message_id='1')
+    retry = main.line_api.session.get_adapter(url).max_retries
+    assert retry.is_retry('GET', 503)
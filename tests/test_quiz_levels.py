@@ -0,0 +1,55 @@
+"""levels.json 的驗證與熱重載。"""
+import copy
+import json
+import os
+
+import pytest
+
+import main
+
+with open(main.QUIZ_CONFIG_PATH, encoding='utf-8') as f:
+    CONFIG = json.load(f)
+
+
+def broken(mutate):
+    config = copy.deepcopy(CONFIG)
+    mutate(config)
+    return config
+
+
+def test_repo_levels_compile():
+    levels = main.compile_levels(CONFIG, main.QUIZ_ACTIONS)
+    assert levels.lookup(1, 'B').next == 2
+
+
+@pytest.mark.parametrize('config', [
+    [],
+    broken(lambda c: c.update(stages=[])),
+    broken(lambda c: c['stages']['1'].update(inputs=[])),
+    broken(lambda c: c['stages']['1']['inputs'].update(B='2')),
+    broken(lambda c: c['stages']['1']['inputs']['B'].update(reply='q2')),
+    broken(lambda c: c['stages']['1']['inputs']['B'].update(next=99)),
+    broken(lambda c: c['stages']['1']['inputs']['B'].update(next=[2])),
+    broken(lambda c: c['stages']['-1']['default'].pop('next')),
+    broken(lambda c: c['messages'].update(q1='text')),
+    broken(lambda c: c['stages'].update(one={})),
+])
+def test_malformed_levels_raise_value_error(config):
+    with pytest.raises(ValueError):
+        main.compile_levels(config, main.QUIZ_ACTIONS)
+
+
+def test_reload_keeps_old_levels_when_file_is_malformed(tmp_path):
+    path = tmp_path / 'levels.json'
+    path.write_text(json.dumps(CONFIG), encoding='utf-8')
+    engine = main.QuizEngine(str(path), main.QUIZ_ACTIONS, reload_interval=0)
+    old = engine.levels
+
+    path.write_text(json.dumps(broken(lambda c: c['stages']['1'].update(inputs=[]))), encoding='utf-8')
+    os.utime(path, (1, 1))
+    assert engine.current() is old
+    assert engine.current() is old
+
+    path.write_text(json.dumps(CONFIG), encoding='utf-8')
+    os.utime(path, (2, 2))
+    assert engine.current() is not old
@@ -0,0 +1,35 @@
+"""兌獎的 compare-and-set 與 F欄 寫回位置。"""
+import threading
+
+import main
+
+
+def test_concurrent_redeem_succeeds_exactly_once(spreadsheet, complete, tmp_path):
+    complete(main.storage, 'U_a', 'a', 30.0)
+    # 模擬兩個 gunicorn worker：各自的 SqliteBackend 指向同一個檔案
+    backends = [main.storage, main.SqliteBackend(main.storage.path)]
+    barrier = threading.Barrier(len(backends))
+    results = []
+
+    def redeem(backend):
+        barrier.wait()
+        results.append(backend.redeem('U_a'))
+
+    threads = [threading.Thread(target=redeem, args=(backend,)) for backend in backends]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == ['already_redeemed', 'success']
+
+
+def test_redeem_marks_every_hot_row_including_the_latest_play(spreadsheet, complete):
+    complete(main.storage, 'U_a', 'a', 30.0)
+    main.sheet_syncer.flush_all()
+    complete(main.storage, 'U_a', 'a', 25.0)
+    main.sheet_syncer.flush_all()
+    assert main.storage.redeem('U_a') == 'success'
+    main.sheet_syncer.flush_all()
+
+    rows = {row[0]: row[5] for row in spreadsheet.sheet1.rows[1:]}
+    assert rows == {'1-1': '否', '2-1': '是', '2-2': '是'}
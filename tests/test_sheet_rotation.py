@@ -0,0 +1,73 @@
+"""熱表輪替的回歸測試 (假工作表與 fixture 在 conftest.py)。"""
+import pytest
+
+import main
+
+
+def test_rotate_redeem_rebootstrap_does_not_duplicate_players(spreadsheet, complete, tmp_path):
+    assert main.sheet_rotator.rotate() == 1
+    complete(main.storage, 'U_new', 'new', 30.0)
+    main.sheet_syncer.flush_all()
+    assert main.storage.redeem('U_old') == 'success'
+    main.sheet_syncer.flush_all()
+
+    summary = spreadsheet.worksheet(main.SHEET_SUMMARY_TITLE).get_all_values()
+    assert [row[0] for row in summary[1:]] == ['U_old']
+    assert summary[1][3] == '是'
+
+    fresh = main.SqliteBackend(str(tmp_path / 'fresh.sqlite3'))
+    fresh.bootstrap(spreadsheet.sheet1.get_all_values(), summary)
+    assert fresh.top_first_completions(5) == [('new', 30.0), ('old', 50.0)]
+    assert fresh.completion_totals() == {'completions': 2, 'players': 2, 'redeemed': 1}
+
+
+def test_rotate_retry_reuses_archive_and_keeps_staff_rows(spreadsheet):
+    staff_row = ['', '現場補登', '2025-01-01 12:00:00', '', '', '是', '', '', '']
+    spreadsheet.sheet1.rows.insert(1, staff_row)
+    main.storage.mark_synced([1], 3)  # 工作人員在上方插入一列，原本的紀錄移到第 3 列
+    spreadsheet.sheet1.fail_delete = 1
+    with pytest.raises(RuntimeError):
+        main.sheet_rotator.rotate()
+    assert main.sheet_rotator.due()
+    main.sheet_rotator.rotate()
+
+    assert len(spreadsheet.archives()) == 1
+    archive = spreadsheet.archives()[0]
+    assert archive.rows[1] == staff_row
+    assert archive.rows[2][4] == 'U_old'
+    assert spreadsheet.sheet1.rows == [spreadsheet.header]
+    assert not main.sheet_rotator.due()
+
+
+def test_redemption_after_half_finished_rotation_hits_the_right_row(spreadsheet, complete):
+    complete(main.storage, 'U_b', 'b', 40.0)
+    complete(main.storage, 'U_c', 'c', 45.0)
+    main.sheet_syncer.flush_all()
+    spreadsheet.sheet1.fail_delete = 1
+    with pytest.raises(RuntimeError):
+        main.sheet_rotator.rotate()
+    complete(main.storage, 'U_e', 'e', 20.0)
+    complete(main.storage, 'U_f', 'f', 25.0)
+    # flush 先接續輪替：刪除生效但回應逾時，新紀錄還不能 append
+    spreadsheet.sheet1.fail_after_delete = 1
+    with pytest.raises(RuntimeError):
+        main.sheet_syncer.flush_all()
+    assert spreadsheet.sheet1.rows == [spreadsheet.header]
+    main.sheet_syncer.flush_all()
+
+    assert main.storage.redeem('U_e') == 'success'
+    main.sheet_syncer.flush_all()
+
+    rows = spreadsheet.sheet1.rows
+    assert [row[4] for row in rows[1:]] == ['U_e', 'U_f']
+    assert [row[5] for row in rows[1:]] == ['是', '否']
+    assert len(spreadsheet.archives()) == 1
+
+
+def test_summary_is_resized_before_each_rewrite(spreadsheet, complete):
+    main.sheet_rotator.rotate()
+    complete(main.storage, 'U_new', 'new', 30.0)
+    main.sheet_syncer.flush_all()
+    main.sheet_rotator.rotate()
+    summary = spreadsheet.worksheet(main.SHEET_SUMMARY_TITLE)
+    assert [rows for ws, rows in spreadsheet.resizes if ws is summary] == [2, 3]